@@ -104,7 +104,7 @@ class openmm_job_AmberABFE_zrestr(openmm_job_ATM):
         prmtopfile = self.basename + ".prmtop"
         crdfile = self.basename + ".inpcrd"
 
-        if not self.stateparams:
+        if self.state_table is None:
             self._buildStates()
         
         #builds service worker for replicas use
@@ -115,7 +115,9 @@ class openmm_job_AmberABFE_zrestr(openmm_job_ATM):
         for i in range(self.nreplicas):
             replica = OMMReplicaATM(i, self.basename, self.service_worker, self.logger)
             if replica.stateid == None:
-                replica.set_state(i, self.stateparams[i])#initial setting
+                replica.set_state(i, self.state_table[i])#initial setting
+            else:
+                replica.set_state(replica.stateid, self.state_table[replica.stateid])
             self.openmm_replicas.append(replica)
 
         # creates openmm workers objects
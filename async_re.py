@@ -11,15 +11,20 @@ from __future__ import division
 import os
 import sys
 import time
+import math
 import pickle
+import json
 import random, glob
 import shutil
 import logging, logging.config
 import signal
+import numpy as np
 
 from configobj import ConfigObj
 
 from gibbs_sampling import *
+from launch_policies import launch_policies
+from exchange_stats import exchange_statistics
 
 from ommreplica import *
 from ommworker import *
@@ -29,6 +34,77 @@ import multiprocessing as mp
 
 __version__ = '3.3.0'
 
+def _write_atomic(filename, text):
+    """
+    Writes text to a temporary file then renames it over filename so that
+    readers never see a partially written file.
+    """
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'w') as f:
+        f.write(text)
+    os.replace(tmpfile, filename)
+
+class replica_status(object):
+    """
+    Status table of the replicas
+
+    Holds the current state id, cycle and running status ('W' waiting,
+    'R' running, 'S' stopped) of each replica. The sets of waiting and running
+    replicas are updated on status transitions rather than recomputed
+    by scanning the table.
+    """
+    def __init__(self, nreplicas):
+        self.nreplicas = nreplicas
+        self.stateid = np.arange(nreplicas, dtype=np.int64)
+        self.cycle = np.ones(nreplicas, dtype=np.int64)
+        self.running_status = np.full(nreplicas, 'W', dtype='U1')
+        self._index = {'W': set(range(nreplicas)), 'R': set(), 'S': set()}
+        #waiting replicas that have completed at least one cycle
+        self._exchangeable = set()
+        #incremented at every change of the table
+        self.version = 0
+
+    def _update_exchangeable(self, repl):
+        if self.running_status[repl] == 'W' and self.cycle[repl] > 1:
+            self._exchangeable.add(repl)
+        else:
+            self._exchangeable.discard(repl)
+
+    def set_running_status(self, repl, status):
+        old_status = self.running_status[repl]
+        if status == old_status:
+            return
+        self._index[old_status].discard(repl)
+        self._index[status].add(repl)
+        self.running_status[repl] = status
+        self._update_exchangeable(repl)
+        self.version += 1
+
+    def set_cycle(self, repl, cycle):
+        self.cycle[repl] = cycle
+        self._update_exchangeable(repl)
+        self.version += 1
+
+    def set_stateid(self, repl, stateid):
+        self.stateid[repl] = stateid
+        self.version += 1
+
+    def swap_states(self, repl_i, repl_j):
+        sid_i = self.stateid[repl_i]
+        self.stateid[repl_i] = self.stateid[repl_j]
+        self.stateid[repl_j] = sid_i
+        self.version += 1
+
+    def replicas(self, status):
+        # list of replica indices with the given running status
+        return sorted(self._index[status])
+
+    def count(self, status):
+        return len(self._index[status])
+
+    def replicas_waiting_to_exchange(self):
+        return sorted(self._exchangeable)
+
 class async_re(object):
     """
     Class to set up and run asynchronous file-based RE calculations
@@ -91,36 +167,41 @@ class async_re(object):
     def _setLogger(self):
         self.logger = logging.getLogger("async_re")
 
-    def __getattribute__(self, name):
-        if name == 'replicas_waiting':
-            # Return a list of replica indices of replicas in a wait state.
-            return [k for k in range(self.nreplicas)
-                    if self.status[k]['running_status'] == 'W']
-        elif name == 'states_waiting':
-            # Return a list of state ids of replicas in a wait state.
-            return [self.status[k]['stateid_current']
-                    for k in self.replicas_waiting]
-        elif name == 'replicas_waiting_to_exchange':
-            # Return a list of replica indices of replicas in a wait state that
-            # have ALSO completed at least one cycle.
-            return [k for k in range(self.nreplicas)
-                    if (self.status[k]['running_status'] == 'W' and
-                        self.status[k]['cycle_current'] > 1)]
-        elif name == 'states_waiting_to_exchange':
-            # Return a list of state ids of replicas in a wait state that have
-            # ALSO completed at least one cycle.
-            return [self.status[k]['stateid_current']
-                    for k in self.replicas_waiting_to_exchange]
-        elif name == 'waiting':
-            return len(self.replicas_waiting)
-        elif name == 'replicas_running':
-            # Return a list of replica indices of replicas in a running state.
-            return [k for k in range(self.nreplicas)
-                    if self.status[k]['running_status'] == 'R']
-        elif name == 'running':
-            return len(self.replicas_running)
-        else:
-            return object.__getattribute__(self,name)
+    @property
+    def replicas_waiting(self):
+        # Return a list of replica indices of replicas in a wait state.
+        return self.status.replicas('W')
+
+    @property
+    def states_waiting(self):
+        # Return a list of state ids of replicas in a wait state.
+        return [int(self.status.stateid[k]) for k in self.replicas_waiting]
+
+    @property
+    def replicas_waiting_to_exchange(self):
+        # Return a list of replica indices of replicas in a wait state that
+        # have ALSO completed at least one cycle.
+        return self.status.replicas_waiting_to_exchange()
+
+    @property
+    def states_waiting_to_exchange(self):
+        # Return a list of state ids of replicas in a wait state that have
+        # ALSO completed at least one cycle.
+        return [int(self.status.stateid[k])
+                for k in self.replicas_waiting_to_exchange]
+
+    @property
+    def waiting(self):
+        return self.status.count('W')
+
+    @property
+    def replicas_running(self):
+        # Return a list of replica indices of replicas in a running state.
+        return self.status.replicas('R')
+
+    @property
+    def running(self):
+        return self.status.count('R')
 
     def _printStatus(self):
         """Print a report of the input parameters."""
@@ -205,6 +286,88 @@ class async_re(object):
         else:
             self.engine_environment = []
 
+        # minimum time in seconds between rewrites of the status files
+        if self.keywords.get('STATUS_TIME') is None:
+            self.status_time = 5.0
+        else:
+            self.status_time = float(self.keywords.get('STATUS_TIME'))
+
+        # seed of the random number generator of the scheduler and of the
+        # exchanges, for reproducible runs. The state of the generator is
+        # saved with the checkpoints and restored at restart.
+        if self.keywords.get('RANDOM_SEED') is None:
+            self.random_seed = None
+        else:
+            self.random_seed = int(self.keywords.get('RANDOM_SEED'))
+
+        # time in seconds between dumps of the exchange statistics
+        if self.keywords.get('STATS_TIME') is None:
+            self.stats_time = 300.0
+        else:
+            self.stats_time = float(self.keywords.get('STATS_TIME'))
+
+        # Maximum time in between cycles in seconds. A cycle ends earlier
+        # as soon as a replica completes.
+        # If unspecified it is set as 30 secs
+        if self.keywords.get('CYCLE_TIME') is None:
+            self.cycle_time = 30.0
+        else:
+            self.cycle_time = float(self.keywords.get('CYCLE_TIME'))
+
+        # Maximum time in seconds between checks for crashed devices
+        if self.keywords.get('MIN_TIME') is None:
+            self.min_time = 1
+        else:
+            self.min_time = float(self.keywords.get('MIN_TIME'))
+
+        # size of subjob buffer as a percentage of job slots
+        if self.keywords.get('SUBJOBS_BUFFER_SIZE') is None:
+            self.subjobs_buffer_size = 0.5
+        else:
+            self.subjobs_buffer_size = float(self.keywords.get('SUBJOBS_BUFFER_SIZE'))
+
+        # set to 'yes' to adjust CYCLE_TIME, MIN_TIME and SUBJOBS_BUFFER_SIZE
+        # during the run based on the measured duration of the segments
+        autotune = self.keywords.get('AUTO_TUNE')
+        self.autotune = autotune is not None and autotune.lower() == 'yes'
+
+        # set to 'yes' to scale the length of the segments on each device
+        # with its measured speed, so that segments take similar wall time on
+        # heterogeneous devices (PRODUCTION_STEPS on a device of average speed)
+        segment_scaling = self.keywords.get('SEGMENT_SCALING')
+        self.segment_scaling = segment_scaling is not None and segment_scaling.lower() == 'yes'
+
+        # number of Gibbs sampling sweeps over the waiting replicas
+        # at each exchange attempt
+        if self.keywords.get('EXCHANGE_SWEEPS') is None:
+            self.exchange_sweeps = 1
+        else:
+            self.exchange_sweeps = int(self.keywords.get('EXCHANGE_SWEEPS'))
+
+        # order in which waiting replicas are launched, see launch_policies
+        self.launch_policy_name = self.keywords.get('LAUNCH_POLICY')
+        if self.launch_policy_name is None:
+            self.launch_policy_name = 'least_cycles'
+        if self.launch_policy_name not in launch_policies:
+            self._exit("unknown LAUNCH_POLICY %s" % self.launch_policy_name)
+
+        # set to 'yes' to have each replica attempt exchanges with the pool
+        # of waiting replicas as soon as it completes a segment rather than
+        # sampling all of the waiting replicas once per cycle
+        exchange_on_completion = self.keywords.get('EXCHANGE_ON_COMPLETION')
+        self.exchange_on_completion = (exchange_on_completion is not None and
+                                       exchange_on_completion.lower() == 'yes')
+
+        # exchanges among all of the waiting replicas ('gibbs'), or only
+        # between replicas in neighboring states ('neighbor'), for large
+        # numbers of states, see _buildStateGraph()
+        self.exchange_mode = self.keywords.get('EXCHANGE_MODE')
+        if self.exchange_mode is None:
+            self.exchange_mode = 'gibbs'
+        self.exchange_mode = self.exchange_mode.lower()
+        if self.exchange_mode not in ('gibbs', 'neighbor'):
+            self._exit("unknown EXCHANGE_MODE %s" % self.exchange_mode)
+
         # number of replicas (may be determined by other means)
         self.nreplicas = None
 
@@ -222,96 +385,136 @@ class async_re(object):
         self.stepgap = self.keywords.get('PRNT_FREQUENCY')
 
     def setupJob(self):
-        self.transport = LocalOpenMMTransport(self.basename, self.openmm_workers, self.openmm_replicas)
+        self.rng = np.random.default_rng(self.random_seed)
+        self._loadRandomState()
+        self.transport = LocalOpenMMTransport(self.basename, self.openmm_workers, self.openmm_replicas, self.rng)
+        self.transport.setSegmentScaling(self.segment_scaling)
         # create status table
-        self.status = [{'stateid_current': k, 'running_status': 'W',
-                        'cycle_current': 1} for k in range(self.nreplicas)]
+        self.status = replica_status(self.nreplicas)
+        # replicas that completed a segment since the last exchange attempt
+        self._completed_replicas = []
+        # number of segments completed in each state
+        self.state_visits = np.zeros(self.nreplicas, dtype=np.int64)
+        self.launch_policy = launch_policies[self.launch_policy_name](self)
+        # states that can be visited from each state
+        self.state_compatible = self._buildStateCompatibility()
+        # graph of the states between which replicas can be exchanged
+        self.state_neighbors = None
+        if self.exchange_mode == 'neighbor':
+            self.state_neighbors = self._buildStateGraph()
+        # exchange, state visit and round trip statistics
+        self.stats = exchange_statistics(self.nreplicas, self.nreplicas, self.state_neighbors)
+        stats_ckpt = self.basename + "_stats_ckpt.npz"
+        if os.path.isfile(stats_ckpt):
+            if not self.stats.load(stats_ckpt):
+                self.logger.warning("%s does not match the current states, statistics are reset" % stats_ckpt)
+        self._stats_write_time = time.time()
         for replica in self.openmm_replicas:
-            self.status[replica._id]['cycle_current'] = replica.get_cycle()
-            self.status[replica._id]['stateid_current'] = replica.get_stateid()
-            self.logger.info("Replica %d Cycle %d Stateid %d" % (replica._id, self.status[replica._id]['cycle_current'], self.status[replica._id]['stateid_current']))
+            self.status.set_cycle(replica._id, replica.get_cycle())
+            self.status.set_stateid(replica._id, replica.get_stateid())
+            self.logger.info("Replica %d Cycle %d Stateid %d" % (replica._id, self.status.cycle[replica._id], self.status.stateid[replica._id]))
+        self._loadStoppedReplicas()
         self.updateStatus()
 
-        self.print_status()
-        
+        self._status_write_time = 0
+        self._status_written_version = None
+        self.print_status(force = True)
+
     def scheduleJobs(self):
-        # Gets the wall clock time for a replica to complete a cycle
+        # Gets the wall clock time in minutes for a replica to complete a cycle.
+        # It is used only until the duration of the segments has been measured.
         # If unspecified it is estimated as 10% of job wall clock time
-        replica_run_time = self.keywords.get('REPLICA_RUN_TIME')
         if self.keywords.get('REPLICA_RUN_TIME') is None:
-            replica_run_time = int(round(self.walltime/10.))
-        else:
-            replica_run_time = int(self.keywords.get('REPLICA_RUN_TIME'))
-        # double it to give time for current running processes
-        # and newly submitted processes to complete
-        replica_run_time *= 2
-
-        # Time in between cycles in seconds
-        # If unspecified it is set as 30 secs
-        if self.keywords.get('CYCLE_TIME') is None:
-            cycle_time = 30.0
+            replica_run_time = self.walltime/10.
         else:
-            cycle_time = float(self.keywords.get('CYCLE_TIME'))
-
-        if self.keywords.get('MIN_TIME') is None:
-            min_time = 1
-        else:
-            min_time = float(self.keywords.get('MIN_TIME'))
+            replica_run_time = float(self.keywords.get('REPLICA_RUN_TIME'))
 
         if self.keywords.get('CHECKPOINT_TIME') is None:
-            checkpoint_time = cycle_time
+            checkpoint_time = self.cycle_time
         else:
             checkpoint_time = float(self.keywords.get('CHECKPOINT_TIME'))
 
         start_time = time.time()
-        end_time = (start_time + 60*(self.walltime - replica_run_time) -
-                    cycle_time - 10)
+        # time by which the final checkpoint should start
+        end_time = start_time + 60*self.walltime - 10
+        # estimated duration of a checkpoint, updated as checkpoints are taken
+        self._checkpoint_duration = 30.0
+        self.transport.setDeadline(end_time - self._checkpoint_duration, 60*replica_run_time)
         last_checkpoint_time = start_time
+        self._scheduler_overhead = None
 
-        while time.time() < end_time and self.transport.numNodesAlive() > 0 :
+        # runs until no device is expected to complete a segment before the
+        # deadline, or until stopped replicas cut the ladder of states
+        while self.transport.numNodesAlive() > 0 and self.transport.canLaunch() and not self._ladderBlocked():
             current_time = time.time()
+            wait_time = self.transport.wait_time
 
             self.updateStatus()
-            self.print_status()
             self.launchJobs()
-            self.updateStatus()
-            self.print_status()
 
-            self.transport.ProcessJobQueue(min_time,cycle_time)
+            self.transport.ProcessJobQueue(self.min_time,
+                                           min(self.cycle_time, max(0, end_time - current_time)))
 
             self.updateStatus()
-            self.print_status()
+            self._adaptStates(self._completed_replicas)
             if self.exchange:
                 self.doExchanges()
+            else:
+                self._completed_replicas = []
             self._write_status()
             self.print_status()
+            # time spent by the scheduler in this cycle other than waiting for
+            # the workers, without the occasional statistics and checkpoints
+            overhead = time.time() - current_time - (self.transport.wait_time - wait_time)
+            if time.time() - self._stats_write_time > self.stats_time:
+                self.write_statistics()
 
             if current_time - last_checkpoint_time > checkpoint_time:
                 self.logger.info("Checkpointing ...")
+                checkpoint_start_time = time.time()
                 self.checkpointJob()
+                if self._refineStates():
+                    self.state_visits[:] = 0
+                    self.stats.reset_states()
+                self.checkpointStatistics()
+                self._checkpoint_duration = max(self._checkpoint_duration,
+                                                2*(time.time() - checkpoint_start_time))
+                self.transport.setDeadline(end_time - self._checkpoint_duration, 60*replica_run_time)
                 last_checkpoint_time = current_time
                 self.logger.info("done.")
 
+            if self.autotune:
+                self._autotune(overhead)
+
         if self.transport.numNodesAlive() <= 0 :
             self.logger.info("No compute devices are alive. Quitting.")
+        if self._ladderBlocked():
+            self.logger.error("Replicas %s are stopped in states that no other replica can visit. Quitting." % self.status.replicas('S'))
 
-        self.transport.DrainJobQueue()
+        # replicas still in the queue are not going to run
+        for k in self.transport.DrainJobQueue():
+            self.status.set_running_status(k, 'W')
         self.updateStatus()
         self.print_status()
-        self.waitJob()
+        # waits for the segments that are expected to complete in time
+        self.waitJob(end_time - self._checkpoint_duration)
         self.checkpointJob()
+        self.checkpointStatistics()
+        self.write_statistics()
+        self.print_status(force = True)
         self.cleanJob()
 
-    def waitJob(self):
-        # wait until all jobs are complete
+    def waitJob(self, deadline = None):
+        # wait until all jobs are complete or until the deadline
         completed = False
         while not completed:
             self.updateStatus()
-            completed = True
-            for k in range(self.nreplicas):
-                if self.status[k]['running_status'] == "R":
-                    completed = False
-            time.sleep(1)
+            completed = self.running == 0
+            if not completed:
+                if deadline is not None and time.time() > deadline:
+                    self.logger.warning("waitJob(): %d replicas still running at the end of the allotted time", self.running)
+                    break
+                self.transport.waitForCompletion(1)
 
     def cleanJob(self):
         self._cleanup()
@@ -323,28 +526,77 @@ class async_re(object):
     def _write_status(self):
         pass
 
+    def write_statistics(self):
+        # dumps the exchange statistics, see exchange_stats
+        self.stats.save(self.basename + "_stats.npz")
+        self._stats_write_time = time.time()
+
+    def checkpointStatistics(self):
+        self.stats.save(self.basename + "_stats_ckpt.npz")
+        self._saveRandomState()
+        self._saveStoppedReplicas()
+
+    def _saveRandomState(self):
+        # the state of the random number generator, to replay a run from the checkpoint
+        _write_atomic(self.basename + "_rng_ckpt.json", json.dumps(self.rng.bit_generator.state))
+
+    def _loadRandomState(self):
+        rngfile = self.basename + "_rng_ckpt.json"
+        if not os.path.isfile(rngfile):
+            return
+        with open(rngfile) as f:
+            state = json.load(f)
+        if state.get('bit_generator') != self.rng.bit_generator.state['bit_generator']:
+            self.logger.warning("%s does not match the random number generator, it is not restored" % rngfile)
+            return
+        self.rng.bit_generator.state = state
+
     def _read_status(self):
         pass
 
-    def print_status(self):
+    def print_status(self, force = False):
         """
-        Writes to BASENAME_stat.txt a text version of the status of the RE job.
+        Writes to BASENAME_stat.txt a text version of the status of the RE job
+        and to BASENAME_stat.json a compact machine-readable snapshot of it.
         It's fun to follow the progress in real time by doing:
         watch cat BASENAME_stat.txt
+
+        The files are rewritten only if the status has changed, at most once
+        every STATUS_TIME seconds unless force is set, and are replaced
+        atomically.
         """
-        log = 'Replica  State  Status  Cycle \n'
+        if self.status.version == self._status_written_version:
+            return
+        current_time = time.time()
+        if not force and current_time - self._status_write_time < self.status_time:
+            return
+
+        _write_atomic('%s_stat.txt' % self.basename, self._status_text())
+        _write_atomic('%s_stat.json' % self.basename,
+                      json.dumps(self._status_snapshot(), separators=(',',':')))
+
+        self._status_write_time = current_time
+        self._status_written_version = self.status.version
+
+    def _status_text(self):
+        lines = ['Replica  State  Status  Cycle ']
         for k in range(self.nreplicas):
-            log += ('%6d   %5d  %5s  %5d \n'%
-                    (k,self.status[k]['stateid_current'],
-                     self.status[k]['running_status'],
-                     self.status[k]['cycle_current']))
-        log += 'Running = %d\n'%self.running
-        log += 'Waiting = %d\n'%self.waiting
-
-        logfile = '%s_stat.txt'%self.basename
-        ofile = _open(logfile,'w')
-        ofile.write(log)
-        ofile.close()
+            lines.append('%6d   %5d  %5s  %5d ' %
+                         (k,self.status.stateid[k],
+                          self.status.running_status[k],
+                          self.status.cycle[k]))
+        lines.append('Running = %d' % self.running)
+        lines.append('Waiting = %d' % self.waiting)
+        return '\n'.join(lines) + '\n'
+
+    def _status_snapshot(self):
+        # status of replica k is the k-th character of 'status'
+        return { 'time': time.time(),
+                 'running': self.running,
+                 'waiting': self.waiting,
+                 'stateid': self.status.stateid.tolist(),
+                 'status': ''.join(self.status.running_status),
+                 'cycle': self.status.cycle.tolist() }
 
     def _buildInpFile(self, repl):
         pass
@@ -357,27 +609,65 @@ class async_re(object):
         self._write_status()
 
     def _updateStatus_replica(self, replica):
-        this_cycle = self.status[replica]['cycle_current']
-        if self.status[replica]['running_status'] == 'R':
+        this_cycle = self.status.cycle[replica]
+        if self.status.running_status[replica] == 'R':
             if self.transport.isDone(replica,this_cycle):
-                self.status[replica]['running_status'] = 'S'
+                self.status.set_running_status(replica, 'S')
                 #MD engine modules implement ways to check for completion.
                 #by testing existence of output file, etc.
                 if self._hasCompleted(replica,this_cycle):
-                    self.status[replica]['cycle_current'] += 1
+                    self.status.set_cycle(replica, this_cycle + 1)
+                    self._completed_replicas.append(replica)
+                    self._applyStateMoves(replica)
+                    self._record_segment(replica)
+                    self.status.set_running_status(replica, 'W')
+                elif self._isStopped(replica):
+                    #the replica stays in the stopped status, see _ladderBlocked()
+                    self.logger.error('_updateStatus_replica(): replica %s (cycle %s) is not run again',
+                                      replica, this_cycle)
+                    self._logStoppedReplica(replica)
                 else:
                     self.logger.warning('_updateStatus_replica(): restarting replica %s (cycle %s)',
                                         replica, this_cycle)
-                self.status[replica]['running_status'] = 'W'
+                    self.status.set_running_status(replica, 'W')
         self.update_state_of_replica(replica)
 
-    def _njobs_to_run(self):
-        # size of subjob buffer as a percentage of job slots
-        subjobs_buffer_size = self.keywords.get('SUBJOBS_BUFFER_SIZE')
-        if subjobs_buffer_size is None:
-            subjobs_buffer_size = 0.5
+    def _autotune(self, overhead):
+        """
+        Adjusts the longest wait between cycles (CYCLE_TIME), the interval
+        between checks for crashed devices (MIN_TIME) and the size of the
+        launch queue (SUBJOBS_BUFFER_SIZE) from the measured duration of the
+        segments on each device and from the time the scheduler spends between
+        waits for the workers.
+        """
+        if self._scheduler_overhead is None:
+            self._scheduler_overhead = overhead
         else:
-            subjobs_buffer_size = float(subjobs_buffer_size)
+            self._scheduler_overhead += 0.25*(overhead - self._scheduler_overhead)
+
+        times = [t for t in self.transport.segmentTimes() if t is not None]
+        if len(times) == 0:
+            return
+
+        # number of segments completed per second by all of the devices
+        completion_rate = sum(1.0/t for t in times)
+        # wait at most the duration of a segment on the slowest device
+        self.cycle_time = min(max(max(times), 1.0), 600.0)
+        # check for crashed devices several times per segment of the fastest device
+        self.min_time = min(max(0.1*min(times), 0.5), 30.0)
+        # queue enough replicas to feed the devices that complete while the
+        # scheduler is busy, leaving the others waiting for exchanges
+        nqueued = 1 + int(math.ceil(2.0*self._scheduler_overhead*completion_rate))
+        self.subjobs_buffer_size = min(1.0, float(nqueued)/self.num_nodes)
+
+        if self.verbose:
+            self.logger.debug('autotune: segment times: %s', ', '.join(['%.2f' % t for t in times]))
+            self.logger.debug('autotune: scheduler overhead: %f', self._scheduler_overhead)
+            self.logger.debug('autotune: CYCLE_TIME = %f MIN_TIME = %f SUBJOBS_BUFFER_SIZE = %f',
+                              self.cycle_time, self.min_time, self.subjobs_buffer_size)
+
+    def _njobs_to_run(self):
+        subjobs_buffer_size = self.subjobs_buffer_size
 
         # launch new replicas if the number of submitted/running subjobs is
         # less than the number of available slots
@@ -395,28 +685,139 @@ class async_re(object):
         return nlaunch
 
     def _cycle_of_replica(self,repl):
-        return self.status[repl]['cycle_current']
+        return self.status.cycle[repl]
+
+    def _state_end(self, stateid):
+        # -1 or 1 if the state is at the beginning or at the end of the
+        # ladder of states, 0 otherwise
+        if stateid == 0:
+            return -1
+        elif stateid == self.nreplicas - 1:
+            return 1
+        return 0
+
+    def _refineStates(self):
+        """
+        Changes the parameters of the states at a checkpoint, returns True
+        if they have changed. Nothing by default.
+        """
+        return False
+
+    def _replicasShareStates(self):
+        """
+        Returns True if the replicas can move among the states on their own,
+        so that they can visit the states held by stopped replicas. False
+        by default.
+        """
+        return False
+
+    def _logStoppedReplica(self, repl):
+        stateid = self.status.stateid[repl]
+        if self._replicasShareStates():
+            self.logger.warning("replica %d is stopped in state %d, the other replicas can still visit the state" % (repl, stateid))
+        else:
+            self.logger.error("replica %d is stopped in state %d, no other replica can be exchanged into the state" % (repl, stateid))
+
+    def _ladderBlocked(self):
+        #True if stopped replicas hold states that no other replica can visit
+        return self.status.count('S') > 0 and not self._replicasShareStates()
+
+    def _saveStoppedReplicas(self):
+        # the replicas stopped after failing repeatedly are not run again
+        # after a restart, remove the file to retry them
+        stopped = [int(k) for k in self.status.replicas('S')]
+        _write_atomic(self.basename + "_stopped_ckpt.json", json.dumps(stopped))
+
+    def _loadStoppedReplicas(self):
+        stoppedfile = self.basename + "_stopped_ckpt.json"
+        if not os.path.isfile(stoppedfile):
+            return
+        with open(stoppedfile) as f:
+            stopped = json.load(f)
+        for k in stopped:
+            if 0 <= k < self.nreplicas:
+                self.status.set_running_status(k, 'S')
+                self.logger.info("Replica %d has been stopped by a previous run, see %s" % (k, stoppedfile))
+                self._logStoppedReplica(k)
+
+    def _isStopped(self, repl):
+        """
+        Returns True if replica repl, which has failed to complete a cycle,
+        is not to be run again. Implemented by the MD engine modules, False
+        by default.
+        """
+        return False
+
+    def _applyStateMoves(self, repl):
+        """
+        Updates the state of replica repl after a segment in which it has
+        moved among the states (expanded ensemble). Nothing by default.
+        """
+        pass
+
+    def _adaptStates(self, replicas):
+        """
+        Updates adaptive parameters of the states from the replicas that
+        completed a segment since the last exchange. Nothing by default.
+        """
+        pass
+
+    def _buildStateCompatibility(self):
+        """
+        Returns the boolean matrix of the states that can be visited by a
+        replica in each state, compatible[a][b] being False if a replica
+        in state a cannot be exchanged into state b, or None if every state
+        can be visited from every other state (the default).
+        """
+        return None
+
+    def _buildStateGraph(self):
+        """
+        Returns the list of the arrays of the ids of the states neighboring
+        each state, used by the neighbor exchange mode. By default the states
+        form a ladder in which each state neighbors the previous and the next
+        compatible state.
+        """
+        n = self.nreplicas
+        compatible = self.state_compatible
+        return [np.array([b for b in (a - 1, a + 1) if 0 <= b < n and (compatible is None or compatible[a][b])],
+                         dtype=np.int64)
+                for a in range(n)]
+
+    def _record_segment(self, repl):
+        # updates the sampling counters after a replica has completed a segment
+        stateid = self.status.stateid[repl]
+        self.state_visits[stateid] += 1
+        end = self._state_end(stateid)
+        self.stats.record_segment(repl, stateid, end, self.status.cycle[repl])
 
     def launchJobs(self):
         """
-        Scans the replicas in wait state and randomly launches them
+        Scans the replicas in wait state and launches them in the order
+        set by the launch policy
         """
         jobs_to_launch = self._njobs_to_run()
         if jobs_to_launch > 0:
-            #prioritize replicas that are most behind
-            wait = sorted(self.replicas_waiting, key=self._cycle_of_replica)
-            #  random.shuffle(wait)
+            wait = self.launch_policy.order(self.replicas_waiting)
             n = min(jobs_to_launch,len(wait))
             for k in wait[0:n]:
-                self.logger.info('Launching replica %d cycle %d', k, self.status[k]['cycle_current'])
+                self.logger.info('Launching replica %d cycle %d', k, self.status.cycle[k])
                 # the _launchReplica function is implemented by
                 # MD engine modules
-                status = self._launchReplica(k,self.status[k]['cycle_current'])
+                status = self._launchReplica(k,int(self.status.cycle[k]))
                 if status != None:
-                    self.status[k]['running_status'] = 'R'
+                    self.status.set_running_status(k, 'R')
 
     def doExchanges(self):
-        """Perform exchanges among waiting replicas using Gibbs sampling."""
+        """
+        Perform exchanges among waiting replicas using Gibbs sampling.
+
+        With EXCHANGE_ON_COMPLETION only the replicas that completed a segment
+        since the last call are sampled, against the whole pool of waiting
+        replicas. With EXCHANGE_MODE = neighbor only the swaps between replicas
+        in neighboring states are considered and the energies are evaluated
+        only along the edges of the graph of the states.
+        """
 
         #check the exchange
         if self.verbose:
@@ -425,7 +826,15 @@ class async_re(object):
         replicas_to_exchange = self.replicas_waiting_to_exchange
         states_to_exchange = self.states_waiting_to_exchange
         nreplicas_to_exchange = len(replicas_to_exchange)
-        if nreplicas_to_exchange < 2:
+
+        if self.exchange_on_completion:
+            waiting = set(replicas_to_exchange)
+            replicas_to_sample = [k for k in self._completed_replicas if k in waiting]
+        else:
+            replicas_to_sample = replicas_to_exchange
+        self._completed_replicas = []
+
+        if nreplicas_to_exchange < 2 or len(replicas_to_sample) == 0:
             return 0
 
         if self.verbose:
@@ -433,33 +842,49 @@ class async_re(object):
         
         exchange_start_time = time.time()
 
-        # Matrix of replica energies in each state.
-        # The computeSwapMatrix() function is defined by application classes
+        repls = np.array(replicas_to_exchange)
+        states = np.array(states_to_exchange)
+        position = dict([(k, i) for i, k in enumerate(replicas_to_exchange)])
+        sample_positions = [position[k] for k in replicas_to_sample]
+
+        if self.exchange_mode == 'neighbor':
+            sampling_start_time = time.time()
+            # the _pairEnergies() function is defined by application classes
+            u = lambda s, i: self._pairEnergies(repls[i], s)
+            new_states = neighbor_independence_sampling(u, states, self.state_neighbors,
+                                                        self.exchange_sweeps, sample_positions,
+                                                        self.stats.record_swaps, self.rng)
+            self._setExchangedStates(repls, states, new_states)
+            sampling_time = time.time() - sampling_start_time
+            self.stats.record_exchange(0., sampling_time)
+            return
+
+        # Matrix of the energies of the replicas to exchange (columns) in
+        # their states (rows), see _cached_reduced_energies()
         matrix_start_time = time.time()
-        swap_matrix = self._computeSwapMatrix(replicas_to_exchange,
-                                              states_to_exchange)
+        swap_matrix = self._cached_reduced_energies(repls, states)
         if self.verbose:
             self.logger.info(swap_matrix)
         matrix_time = time.time() - matrix_start_time
 
         sampling_start_time = time.time()
 
-        for repl_i in replicas_to_exchange:
-            #repl_i = choice(replicas_to_exchange)
-            sid_i = self.status[repl_i]['stateid_current']
-            curr_states = [self.status[repl_j]['stateid_current']
-                           for repl_j in replicas_to_exchange]
-            repl_j = pairwise_independence_sampling(repl_i,sid_i,
-                                                    replicas_to_exchange,
-                                                    curr_states,
-                                                    swap_matrix)
-            if repl_j != repl_i:
-                sid_i = self.status[repl_i]['stateid_current']
-                sid_j = self.status[repl_j]['stateid_current']
-                self.status[repl_i]['stateid_current'] = sid_j
-                self.status[repl_j]['stateid_current'] = sid_i
-                self.logger.info("Replica %d new state %d" % (repl_i, sid_j))
-                self.logger.info("Replica %d new state %d" % (repl_j, sid_i))
+        # Gibbs sampling of the permutation of the states among the
+        # replicas to exchange
+        compatible = None
+        if self.state_compatible is not None:
+            compatible = self.state_compatible[np.ix_(states, states)]
+        # the sampler works with the positions of the states in the list
+        record = lambda a, bs, pacc, b: self.stats.record_swaps(states[a], states[bs], pacc,
+                                                                None if b is None else states[b])
+        perm = multi_sweep_independence_sampling(swap_matrix,
+                                                 np.arange(nreplicas_to_exchange),
+                                                 self.exchange_sweeps,
+                                                 sample_positions,
+                                                 compatible,
+                                                 record,
+                                                 self.rng)
+        self._setExchangedStates(repls, states, states[perm])
 
         # Uncomment to debug Gibbs sampling:
         # Actual and observed populations of state permutations should match.
@@ -468,6 +893,23 @@ class async_re(object):
         # self._debug_validate_state_populations(replicas_to_exchange,
         #                                        states_to_exchange,U)
         sampling_time = time.time() - sampling_start_time
+        self.stats.record_exchange(matrix_time, sampling_time)
+
+    def _cached_reduced_energies(self, repls, states):
+        """
+        Returns the matrix of the dimension-less energies of the replicas in
+        repls (columns) in the states in states (rows). Application classes
+        that keep the energies between exchanges override it, by default the
+        matrix is sliced from the one returned by _computeSwapMatrix().
+        """
+        swap_matrix = self._computeSwapMatrix(list(repls), list(states))
+        return np.asarray(swap_matrix)[np.ix_(states, repls)]
+
+    def _setExchangedStates(self, repls, states, new_states):
+        for i in range(len(repls)):
+            if new_states[i] != states[i]:
+                self.status.set_stateid(repls[i], new_states[i])
+                self.logger.info("Replica %d new state %d" % (repls[i], new_states[i]))
 
     # see children classes for specific implementations
     def update_state_of_replica(self, repl):
@@ -0,0 +1,175 @@
+"""
+Exchange, state visit and round trip statistics of ASyncRE-OpenMM
+
+The counters are kept in NumPy arrays, periodically saved to
+BASENAME_stats.npz and saved with the checkpoint in
+BASENAME_stats_ckpt.npz, from which they are restored at restart.
+
+Swap statistics are kept for each state a and each of its exchange partner
+states partners[a] (all of the states, or the neighbors of a in the neighbor
+exchange mode). attempted[a][c] counts the swaps of a replica in state a with
+a replica in state partners[a][c] that have been considered, acceptance[a][c]
+is the sum of their Metropolis acceptance probabilities and accepted[a][c]
+the number of those carried out. acceptance/attempted is the average
+acceptance probability of the pair of states; low values point to the
+windows that throttle the mixing of the states.
+"""
+from __future__ import print_function
+from __future__ import division
+import os
+import time
+import numpy as np
+
+class exchange_statistics(object):
+    def __init__(self, nreplicas, nstates, neighbors = None):
+        self.nreplicas = nreplicas
+        self.nstates = nstates
+        # exchange partners of each state, sorted and padded with nstates
+        if neighbors is None:
+            self.partners = np.tile(np.arange(nstates, dtype=np.int64), (nstates, 1))
+        else:
+            degree = max([len(nb) for nb in neighbors] + [1])
+            self.partners = np.full((nstates, degree), nstates, dtype=np.int64)
+            for a, nb in enumerate(neighbors):
+                self.partners[a, 0:len(nb)] = np.sort(nb)
+        self.attempted = np.zeros(self.partners.shape, dtype=np.int64)
+        self.acceptance = np.zeros(self.partners.shape)
+        self.accepted = np.zeros(self.partners.shape, dtype=np.int64)
+        # number of segments completed by each replica in each state
+        self.replica_state_visits = np.zeros((nreplicas, nstates), dtype=np.int64)
+        # round trips between the end states completed by each replica, and
+        # their total duration in seconds and in segments
+        self.round_trips = np.zeros(nreplicas, dtype=np.int64)
+        self.round_trip_time = np.zeros(nreplicas)
+        self.round_trip_segments = np.zeros(nreplicas, dtype=np.int64)
+        # end state (-1 or 1, 0 if none) at which the current trip started,
+        # whether the other end has been visited, and when the trip started
+        self.trip_end = np.zeros(nreplicas, dtype=np.int8)
+        self.trip_turned = np.zeros(nreplicas, dtype=bool)
+        self.trip_start_time = np.zeros(nreplicas)
+        self.trip_start_cycle = np.zeros(nreplicas, dtype=np.int64)
+        # number of exchange attempts and the time spent computing the swap
+        # matrix and sampling the states
+        self.nexchanges = 0
+        self.matrix_time = 0.
+        self.sampling_time = 0.
+        # run time accumulated by previous runs
+        self.elapsed = 0.
+        self._start_time = time.time()
+
+    def clock(self):
+        # run time in seconds including that of previous runs
+        return self.elapsed + time.time() - self._start_time
+
+    def record_segment(self, repl, stateid, end, cycle):
+        """
+        Records a segment of replica repl in state stateid, end being -1 or 1
+        if the state is an end state and 0 otherwise
+        """
+        self.replica_state_visits[repl, stateid] += 1
+        self.record_visit(repl, end, cycle)
+
+    def record_visit(self, repl, end, cycle):
+        """
+        Updates the round trips of replica repl after a visit to a state
+        during a segment, end being as in record_segment()
+        """
+        if end == 0:
+            return
+        now = self.clock()
+        if self.trip_end[repl] != 0 and end != self.trip_end[repl]:
+            self.trip_turned[repl] = True
+            return
+        if self.trip_turned[repl]:
+            self.round_trips[repl] += 1
+            self.round_trip_time[repl] += now - self.trip_start_time[repl]
+            self.round_trip_segments[repl] += cycle - self.trip_start_cycle[repl]
+        if self.trip_end[repl] == 0 or self.trip_turned[repl]:
+            self.trip_end[repl] = end
+            self.trip_turned[repl] = False
+            self.trip_start_time[repl] = now
+            self.trip_start_cycle[repl] = cycle
+
+    def record_swaps(self, a, bs, pacc, b = None):
+        """
+        Records the swaps considered between a replica in state a and the
+        replicas in states bs with acceptance probabilities pacc, b being the
+        state accepted, if any
+        """
+        # several replicas may hold the same state, repeated columns are
+        # counted once for each replica
+        columns = np.searchsorted(self.partners[a], bs)
+        np.add.at(self.attempted[a], columns, 1)
+        np.add.at(self.acceptance[a], columns, pacc)
+        if b is not None:
+            self.accepted[a, np.searchsorted(self.partners[a], b)] += 1
+
+    def record_exchange(self, matrix_time, sampling_time):
+        self.nexchanges += 1
+        self.matrix_time += matrix_time
+        self.sampling_time += sampling_time
+
+    def pair_acceptance(self, a, b):
+        """
+        Returns the number of swaps considered between states a and b, in
+        either direction, and the sum of their acceptance probabilities
+        """
+        attempted = 0
+        acceptance = 0.
+        for (c, d) in ((a, b), (b, a)):
+            column = np.searchsorted(self.partners[c], d)
+            if column < self.partners.shape[1] and self.partners[c, column] == d:
+                attempted += self.attempted[c, column]
+                acceptance += self.acceptance[c, column]
+        return (attempted, acceptance)
+
+    def reset_states(self):
+        # discards the counters that refer to the parameters of the states,
+        # for example after the states have been changed
+        self.attempted[:] = 0
+        self.acceptance[:] = 0.
+        self.accepted[:] = 0
+        self.replica_state_visits[:] = 0
+
+    def average_acceptance(self):
+        """
+        Returns the average acceptance probability of the swaps between each
+        state and its partner states, NaN for the pairs never considered
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.attempted > 0, self.acceptance/self.attempted, np.nan)
+
+    _fields = ('partners', 'attempted', 'acceptance', 'accepted', 'replica_state_visits',
+               'round_trips', 'round_trip_time', 'round_trip_segments',
+               'trip_end', 'trip_turned', 'trip_start_time', 'trip_start_cycle')
+
+    def save(self, filename):
+        data = dict((name, getattr(self, name)) for name in self._fields)
+        data['nexchanges'] = self.nexchanges
+        data['matrix_time'] = self.matrix_time
+        data['sampling_time'] = self.sampling_time
+        data['elapsed'] = self.clock()
+        tmpfile = filename + '.tmp'
+        with open(tmpfile, 'wb') as f:
+            np.savez_compressed(f, **data)
+        os.replace(tmpfile, filename)
+
+    def load(self, filename):
+        """
+        Restores the counters from a file written by save(). Returns False,
+        leaving the counters unchanged, if the file does not match the
+        number of replicas and the exchange partners of the states.
+        """
+        with np.load(filename) as data:
+            if (data['partners'].shape != self.partners.shape or
+                not np.array_equal(data['partners'], self.partners) or
+                data['round_trips'].shape != self.round_trips.shape):
+                return False
+            for name in self._fields:
+                setattr(self, name, data[name])
+            self.nexchanges = int(data['nexchanges'])
+            self.matrix_time = float(data['matrix_time'])
+            self.sampling_time = float(data['sampling_time'])
+            self.elapsed = float(data['elapsed'])
+        self._start_time = time.time()
+        return True
@@ -1,7 +1,7 @@
 """Gibbs sampling routines"""
 from __future__ import print_function
 from __future__ import division
-from numpy import zeros, exp, sum, log, asarray
+from numpy import zeros, exp, sum, log, asarray, array, arange, cumsum, maximum, searchsorted
 from numpy.random import random as _random
 from random import choice
 from itertools import permutations
@@ -14,9 +14,18 @@ def _exit(message):
     print('exiting...')
     sys.exit(1)
 
-def weighted_choice(choices):
+def _uniform(rng = None):
+    """
+    Return a uniform random number in [0,1) from the numpy Generator rng,
+    or from the global numpy generator if rng is None.
+    """
+    if rng is None:
+        return _random()
+    return rng.random()
+
+def weighted_choice(choices, rng = None):
     """Return a discrete outcome given a set of outcome/weight pairs."""
-    r = _random()*sum(w for c,w in list(choices))
+    r = _uniform(rng)*sum(w for c,w in list(choices))
     for c,w in choices:
         r -= w
         if r < 0:
@@ -24,7 +33,7 @@ def weighted_choice(choices):
     # You should never get here.
     return None
 
-def pairwise_metropolis_sampling(repl_i, sid_i, replicas, states, U):
+def pairwise_metropolis_sampling(repl_i, sid_i, replicas, states, U, rng = None):
     """
     Return a replica "j" to exchange with the given replica "i" based on
     the Metropolis criterion:
@@ -43,7 +52,10 @@ def pairwise_metropolis_sampling(repl_i, sid_i, replicas, states, U):
     nreplicas = len(replicas)
     repl_j = repl_i
     while repl_j == repl_i:
-        j = choice(range(nreplicas))
+        if rng is None:
+            j = choice(range(nreplicas))
+        else:
+            j = int(rng.integers(nreplicas))
         repl_j = replicas[j]
         sid_j = states[j]
     # Apply the Metropolis acceptance criteria. If the move is accepted, return
@@ -52,14 +64,14 @@ def pairwise_metropolis_sampling(repl_i, sid_i, replicas, states, U):
     du = (U[sid_i][repl_j] + U[sid_j][repl_i]
           - U[sid_i][repl_i] - U[sid_j][repl_j])
     if du > 0.:
-        if _random() > exp(-du):
+        if _uniform(rng) > exp(-du):
             return repl_i
         else:
             return repl_j
     else:
         return repl_j
 
-def pairwise_independence_sampling(repl_i, sid_i, replicas, states, U):
+def pairwise_independence_sampling(repl_i, sid_i, replicas, states, U, rng = None):
     """
     Return a replica "j" to exchange with the given replica "i" based on
     independent sampling from the discrete Metropolis transition matrix, T:
@@ -117,4 +129,136 @@ def pairwise_independence_sampling(repl_i, sid_i, replicas, states, U):
         _exit('gibbs_re_j(): unrecoverable error: replica %d not in the '
               'list of waiting replicas?'%i)
 
-    return replicas[weighted_choice(list(zip(range(nreplicas),ps)))]
+    return replicas[weighted_choice(list(zip(range(nreplicas),ps)), rng)]
+
+def multi_sweep_independence_sampling(U, perm, nsweeps = 1, sample = None, compatible = None, record = None,
+                                      rng = None):
+    """
+    Return a new permutation of states among a set of n replicas obtained by
+    repeatedly applying the independence sampling rule of
+    pairwise_independence_sampling() to each replica in turn.
+
+    U is the n x n array of reduced energies, U[a][i] being the energy of
+    replica i in the state currently held by replica a. perm is the integer
+    array of the current permutation, perm[i] being the index of the state
+    held by replica i. Each sweep visits the replicas listed in 'sample'
+    (all replicas by default) once. For large numbers of replicas several
+    sweeps approach the mixing obtained by sampling the distribution of all
+    replica/state permutations directly.
+
+    compatible is an optional n x n boolean array, compatible[a][b] being
+    False if a replica in state a cannot visit state b (rows and columns
+    indexed as the rows of U). Swaps between incompatible states are never
+    accepted and their energies are not evaluated, so the entries of U for
+    incompatible pairs are not used.
+
+    record is an optional function called as record(a, bs, pacc, b) each
+    time a replica in state a is visited, bs being the states of the
+    replicas it could swap with, pacc the Metropolis acceptance
+    probabilities of those swaps and b the state accepted, or None.
+
+    rng is an optional numpy Generator used in place of the global numpy
+    random generator, so that the sampling can be reproduced.
+    """
+    U = asarray(U, dtype=float)
+    perm = array(perm)
+    nreplicas = len(perm)
+    if nreplicas < 2:
+        return perm
+    if sample is None:
+        sample = range(nreplicas)
+    f = 1./(float(nreplicas) - 1.)
+    replicas = arange(nreplicas)
+    for sweep in range(nsweeps):
+        for i in sample:
+            a = perm[i]
+            if compatible is None:
+                js = replicas
+            else:
+                js = replicas[compatible[a, perm] & compatible[perm, a]]
+            bs = perm[js]
+            # du_j = u_a(j) + u_b(i) - [u_a(i) + u_b(j)] with b the state of j
+            du = U[a, js] + U[bs, i] - U[a, i] - U[bs, js]
+            ps = f*exp(-maximum(du, 0.))
+            ps[js == i] = 0.
+            # the replica keeps its state with the remaining probability
+            cps = cumsum(ps)
+            k = int(searchsorted(cps, _uniform(rng), side='right'))
+            j = js[k] if k < len(js) else i
+            if record is not None:
+                others = js != i
+                record(a, bs[others], ps[others]/f, perm[j] if j != i else None)
+            if j != i:
+                perm[i] = perm[j]
+                perm[j] = a
+    return perm
+
+def neighbor_independence_sampling(u, perm, neighbors, nsweeps = 1, sample = None, record = None, rng = None):
+    """
+    Return a new assignment of states to a set of n replicas obtained by
+    applying the independence sampling rule of pairwise_independence_sampling()
+    restricted to the swaps between replicas in neighboring states.
+
+    perm is the integer array of the ids of the states held by the replicas,
+    perm[i] being the state of replica i; several replicas may hold the same
+    state. neighbors[a] is the array of the ids of the states neighboring
+    state a in a graph of the states. Only the swaps between replica i and
+    the replicas holding the neighbors of the state of i are considered.
+    Swaps do not change the number of replicas holding each state, so each
+    swap is proposed with the same probability 1/d, d being the largest
+    number of such partners of any replica, and the proposal is
+    symmetric. u(states, replicas) is a function returning the array of the
+    reduced energies of replicas[k] in states[k]; it is evaluated only along
+    the edges of the graph and each pair of energies is evaluated once.
+    Each sweep visits the replicas listed in 'sample' (all replicas by
+    default) once. record and rng are as in
+    multi_sweep_independence_sampling().
+    """
+    perm = array(perm)
+    nreplicas = len(perm)
+    if nreplicas < 2:
+        return perm
+    if sample is None:
+        sample = range(nreplicas)
+    holders = {}
+    for i, a in enumerate(perm):
+        holders.setdefault(int(a), []).append(i)
+    maxdegree = max(len([j for b in neighbors[a] for j in holders.get(int(b), [])]) for a in holders)
+    if maxdegree == 0:
+        return perm
+    f = 1./float(maxdegree)
+    energies = {}
+    def energy(states, replicas):
+        keys = list(zip(states, replicas))
+        missing = [key for key in set(keys) if key not in energies]
+        if missing:
+            values = u(asarray([a for a, i in missing]), asarray([i for a, i in missing]))
+            energies.update(zip(missing, values))
+        return array([energies[key] for key in keys])
+    for sweep in range(nsweeps):
+        for i in sample:
+            a = int(perm[i])
+            js = [j for b in neighbors[a] for j in holders.get(int(b), [])]
+            if len(js) == 0:
+                continue
+            bs = [int(perm[j]) for j in js]
+            m = len(js)
+            # du_j = u_a(j) + u_b(i) - [u_a(i) + u_b(j)] with b the state of j
+            e = energy([a]*m + bs + [a] + bs, js + [i]*m + [i] + js)
+            du = e[0:m] + e[m:2*m] - e[2*m] - e[2*m+1:]
+            ps = f*exp(-maximum(du, 0.))
+            r = _uniform(rng)
+            cps = cumsum(ps)
+            k = int(searchsorted(cps, r, side='right'))
+            if record is not None:
+                record(a, array(bs), ps/f, bs[k] if k < m else None)
+            if k < m:
+                j = js[k]
+                b = bs[k]
+                perm[i] = b
+                perm[j] = a
+                holders[a].remove(i)
+                holders[a].append(j)
+                holders[b].remove(j)
+                holders[b].append(i)
+    return perm
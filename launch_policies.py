@@ -0,0 +1,69 @@
+"""
+Launch priority policies of ASyncRE-OpenMM
+
+A policy orders the replicas in wait state. Replicas earlier in the
+ordered list are launched first. The policy is selected with the
+LAUNCH_POLICY keyword.
+"""
+from __future__ import print_function
+from __future__ import division
+
+class LaunchPolicy(object):
+    """
+    Base class of the launch policies, launches replicas in index order
+    """
+    def __init__(self, job):
+        self.job = job
+
+    def order(self, replicas):
+        return list(replicas)
+
+class LeastCyclesPolicy(LaunchPolicy):
+    """
+    Launches first the replicas that have completed the fewest cycles
+    """
+    def order(self, replicas):
+        cycle = self.job.status.cycle
+        return sorted(replicas, key=lambda k: cycle[k])
+
+class UndersampledStatesPolicy(LaunchPolicy):
+    """
+    Launches first the replicas in the states with the fewest
+    completed segments, ties are broken by cycle
+    """
+    def order(self, replicas):
+        visits = self.job.state_visits
+        stateid = self.job.status.stateid
+        cycle = self.job.status.cycle
+        return sorted(replicas, key=lambda k: (visits[stateid[k]], cycle[k]))
+
+class RoundTripPolicy(LaunchPolicy):
+    """
+    Launches first the replicas whose current round trip between the end
+    states of the state ladder started the longest ago, those that have not
+    yet visited an end state first, ties are broken by cycle. This favors
+    the replicas whose round trips limit the mixing of the states. The
+    start times of the trips are kept, and checkpointed, by the exchange
+    statistics of the job.
+    """
+    def order(self, replicas):
+        stats = self.job.stats
+        cycle = self.job.status.cycle
+        return sorted(replicas, key=lambda k: (stats.trip_end[k] != 0, stats.trip_start_time[k], cycle[k]))
+
+class RandomPolicy(LaunchPolicy):
+    """
+    Launches the replicas in random order, drawn from the random number
+    generator of the job
+    """
+    def order(self, replicas):
+        replicas = list(replicas)
+        self.job.rng.shuffle(replicas)
+        return replicas
+
+launch_policies = {
+    'least_cycles': LeastCyclesPolicy,
+    'undersampled_states': UndersampledStatesPolicy,
+    'round_trip': RoundTripPolicy,
+    'random': RandomPolicy
+}
@@ -3,10 +3,13 @@ from __future__ import division
 """
 Multiprocessing job transport for AsyncRE/OpenMM
 """
-import os, re, sys, time, shutil, copy, random, signal
+import os, re, sys, time, shutil, copy, random, signal, bisect, itertools
+import threading
 import multiprocessing as mp
+import multiprocessing.connection
 #from multiprocessing import Process, Queue, Event
 import logging
+import numpy as np
 
 from simtk import openmm as mm
 from simtk.openmm.app import *
@@ -26,9 +29,13 @@ class LocalOpenMMTransport(Transport):
     """
     Class to launch and monitor jobs on a set of local GPUs
     """
-    def __init__(self, jobname, openmm_workers, openmm_replicas):
+    def __init__(self, jobname, openmm_workers, openmm_replicas, rng = None):
         # jobname: identifies current asyncRE job
+        # rng: numpy random Generator used to choose among available nodes
         Transport.__init__(self)
+        if rng is None:
+            rng = np.random.default_rng()
+        self.rng = rng
         self.logger = logging.getLogger("async_re.local_openmm_transport")
 
         # openmm contexts
@@ -48,15 +55,69 @@ class LocalOpenMMTransport(Transport):
         # None = no information about where the replica is running
         self.replica_to_job = [ None for k in range(len(openmm_replicas)) ]
 
-        # implements a queue of jobs from which to draw the next job
-        # to launch
-        ctx = mp.get_context('spawn')
-        self.jobqueue = ctx.Queue()
+        # queue of the jobs waiting for a node, a list of entries
+        # (priority, sequence number, replica) kept sorted, see launchJob()
+        self.jobqueue = []
+        self._jobsequence = itertools.count()
+        # node on which each replica has last run
+        self.replica_node = [ None for k in range(len(openmm_replicas)) ]
+        # node whose worker caches the current coordinates of each replica
+        # (None if none does), and whether those of the replica object are
+        # older, see _cacheReplica()
+        self.cached_on = [ None for k in range(len(openmm_replicas)) ]
+        self.posvel_stale = [ False for k in range(len(openmm_replicas)) ]
+        # replicas left stale by syncReplicas() because their worker was
+        # busy, fetched when the worker completes its run
+        self.sync_pending = set()
+        # cycle, MD steps and energies of the stale replicas that go with the
+        # older coordinates of their replica objects, see posvelRecord()
+        self.posvel_record = [ None for k in range(len(openmm_replicas)) ]
+        # whether the last segment of each replica has failed, and the number
+        # of times in a row each replica has been run again after blowing up
+        self.segment_failed = [ False for k in range(len(openmm_replicas)) ]
+        self.recovery_attempts = [ 0 for k in range(len(openmm_replicas)) ]
+        # replicas stopped after blowing up MAX_RECOVERY_ATTEMPTS times in a row
+        self.replica_stopped = [ False for k in range(len(openmm_replicas)) ]
+
+        # parameter sets and force groups under which the energies of the
+        # replicas are evaluated after each segment, see setStateEnergies()
+        self.state_energy_parameters = None
+        self.state_energy_groups = None
+
+        # measured wall-clock duration of the segments on each node
+        # (moving average), None if not yet measured
+        self.segment_time = [ None for k in range(self.nprocs)]
+        self.nsegments = [ 0 for k in range(self.nprocs)]
+        # measured MD steps per second of each node (moving average), None
+        # if not yet measured, and whether the length of the segments is
+        # scaled with it, see setSegmentScaling()
+        self.step_rate = [ None for k in range(self.nprocs)]
+        self.scale_segments = False
+
+        # total time spent waiting for workers to complete
+        self.wait_time = 0.0
+
+        # time by which launched segments should complete (None = no limit)
+        # and duration of a segment assumed for nodes without measurements
+        self.deadline = None
+        self.default_segment_time = None
 
         self.ncrashes = [ 0 for k in range(self.nprocs)]
         self.disabled = [ False for k in range(self.nprocs)]
         self.maxcrashes = 4
 
+        # crashed workers are restarted by supervisor threads, see _fixnodes().
+        # The thread restarting each node (None if none), whether the last
+        # restart has succeeded, and the time before which the node is not
+        # restarted again. Consecutive restarts of a node are delayed by
+        # restart_backoff seconds, doubling with each crash.
+        self.restarting = [ None for k in range(self.nprocs)]
+        self.restart_ok = [ False for k in range(self.nprocs)]
+        self.restart_time = [ 0.0 for k in range(self.nprocs)]
+        self.restart_backoff = 10.0
+        # the supervisor threads wake up waitForCompletion() through this pipe
+        self._wakeup_recv, self._wakeup_send = mp.Pipe(duplex=False)
+
     def _clear_resource(self, replica):
         # frees up the node running a replica identified by replica id
         job = {}
@@ -83,152 +144,503 @@ class LocalOpenMMTransport(Transport):
         return nodeid
 
     def numNodesAlive(self):
+        #crashed nodes count as alive until they are given up
         alive = [node for node in range(self.nprocs)
-                     if self.node_status[node] is None or self.node_status[node] >= 0 ]
+                     if self.node_status[node] is None or self.node_status[node] >= 0
+                     or not self.disabled[node] ]
         return len(alive)
 
-    def _fixnodes(self):
-        for nodeid in range(self.nprocs):
-            if self.node_status[nodeid] is not None and self.node_status[nodeid] < 0 and not self.disabled[nodeid]:
-                if self.ncrashes[nodeid] <= self.maxcrashes:
-                    self.ncrashes[nodeid] += 1
-                    self.logger.warning("fixnodes(): attempting to restart nodeid %d", nodeid)
-                    res = self.openmm_workers[nodeid].start_worker()
-                    if res is not None:
-                        self.node_status[nodeid] = None
-                else:
-                    self.logger.warning("fixnodes(): node %d has crashed too many times; it will not be restarted.", nodeid)
-                    self.disabled[nodeid] = True
-
-    def _availableNode(self):
-        #returns a node at random among available nodes
-        available = [node for node in range(self.nprocs)
-                     if self.node_status[node] is None]
+    def _velocityScale(self, ommreplica):
+        #scaling of the velocities of the replica from the temperature of the
+        #state it has run in to that of its current state
+        (stateid, par) = ommreplica.get_state()
+        if par is None or ommreplica.energy_par is None:
+            return 1.0
+        return math.sqrt(float(par['temperature'])/float(ommreplica.energy_par['temperature']))
+
+    def _fetchReplica(self, replica):
+        #copies the coordinates of a replica from the cache of the worker that
+        #holds them into the replica object, to be called only when the
+        #worker is idle, otherwise it waits for the end of its run
+        ommreplica = self.openmm_replicas[replica]
+        (pos, vel) = self.openmm_workers[self.cached_on[replica]].get_cached_posvel(replica)
+        ommreplica.set_posvel(pos, vel)
+        scale = self._velocityScale(ommreplica)
+        if scale != 1.0:
+            for i in range(0,len(ommreplica.velocities)):
+                ommreplica.velocities[i] = scale*ommreplica.velocities[i]
+        self.posvel_stale[replica] = False
+
+    def _cacheReplica(self, nodeid, replica):
+        #caches the coordinates of a replica that has completed a run in the
+        #worker, evicting the least recently used replica if the cache is full
+        worker = self.openmm_workers[nodeid]
+        if replica not in worker.cached_replicas and len(worker.cached_replicas) >= worker.cache_size:
+            evicted = next(iter(worker.cached_replicas))
+            if self.posvel_stale[evicted]:
+                self._fetchReplica(evicted)
+            self.cached_on[evicted] = None
+            worker.uncache(evicted)
+        old_node = self.cached_on[replica]
+        if old_node is not None and old_node != nodeid:
+            self.openmm_workers[old_node].uncache(replica)
+        worker.cache_posvel(replica)
+        self.cached_on[replica] = nodeid
+
+    def _dropCache(self, nodeid):
+        #the cache of a dead worker is lost, the replicas it held fall back to
+        #the coordinates of the replica objects
+        for replica in range(len(self.cached_on)):
+            if self.cached_on[replica] == nodeid:
+                if self.posvel_stale[replica]:
+                    self.logger.warning("replica %d rolled back to its last coordinates saved by the controller", replica)
+                self.cached_on[replica] = None
+                self.posvel_stale[replica] = False
+        self.openmm_workers[nodeid].cached_replicas.clear()
+
+    def syncReplicas(self):
+        """
+        Updates the replica objects with the coordinates cached by the idle
+        workers, for example before a checkpoint. The busy workers are not
+        waited for: the replicas they hold are fetched when they complete
+        their runs, see _syncPending().
 
-        if available == None or len(available) == 0:
+        Returns the list of the replicas whose replica objects hold older
+        coordinates than those cached by a busy worker.
+        """
+        pending = []
+        for replica in range(len(self.cached_on)):
+            if self.posvel_stale[replica]:
+                if self.node_status[self.cached_on[replica]] is None:
+                    self._fetchReplica(replica)
+                else:
+                    pending.append(replica)
+        self.sync_pending.update(pending)
+        return pending
+
+    def posvelRecord(self, replica):
+        #the cycle, MD steps and energies that go with the coordinates of the
+        #replica object if they are older than those cached by a worker,
+        #None otherwise
+        if not self.posvel_stale[replica]:
             return None
-        random.shuffle(available)
+        return self.posvel_record[replica]
+
+    def _syncPending(self, nodeid):
+        #fetches the replicas left stale by syncReplicas() from the worker
+        #of nodeid that has completed its run
+        for replica in list(self.sync_pending):
+            if not self.posvel_stale[replica]:
+                self.sync_pending.discard(replica)
+            elif self.cached_on[replica] == nodeid:
+                self._fetchReplica(replica)
+                self.sync_pending.discard(replica)
+
+    def _restartWorker(self, nodeid):
+        #body of the supervisor thread restarting the worker of a crashed node
+        try:
+            self.restart_ok[nodeid] = self.openmm_workers[nodeid].start_worker() is not None
+        except Exception:
+            self.logger.exception("unable to restart nodeid %d", nodeid)
+            self.restart_ok[nodeid] = False
+        self._wakeup_send.send(nodeid)
 
-        return available[0]
+    def _fixnodes(self):
+        #restarts crashed nodes in the background, the nodes return to the
+        #pool once their workers are ready
+        now = time.time()
+        for nodeid in range(self.nprocs):
+            if self.node_status[nodeid] is None or self.node_status[nodeid] >= 0 or self.disabled[nodeid]:
+                continue
+            if self.restarting[nodeid] is not None:
+                if self.restarting[nodeid].is_alive():
+                    continue
+                self.restarting[nodeid] = None
+                if self.restart_ok[nodeid]:
+                    self.logger.info("fixnodes(): nodeid %d has been restarted", nodeid)
+                    self.node_status[nodeid] = None
+                    continue
+                self.logger.warning("fixnodes(): restart of nodeid %d has failed", nodeid)
+            if self.ncrashes[nodeid] > self.maxcrashes:
+                self.logger.warning("fixnodes(): node %d has crashed too many times; it will not be restarted.", nodeid)
+                self.disabled[nodeid] = True
+                continue
+            if now < self.restart_time[nodeid]:
+                continue
+            self.ncrashes[nodeid] += 1
+            self.restart_time[nodeid] = now + self.restart_backoff*2**(self.ncrashes[nodeid] - 1)
+            self.logger.warning("fixnodes(): attempting to restart nodeid %d", nodeid)
+            self.restarting[nodeid] = threading.Thread(target=self._restartWorker, args=(nodeid,), daemon=True)
+            self.restarting[nodeid].start()
+
+    def _recordSegmentTime(self, nodeid, elapsed, nsteps):
+        if self.segment_time[nodeid] is None:
+            self.segment_time[nodeid] = elapsed
+        else:
+            self.segment_time[nodeid] += 0.25*(elapsed - self.segment_time[nodeid])
+        if elapsed > 0:
+            rate = nsteps/elapsed
+            if self.step_rate[nodeid] is None:
+                self.step_rate[nodeid] = rate
+            else:
+                self.step_rate[nodeid] += 0.25*(rate - self.step_rate[nodeid])
+        self.nsegments[nodeid] += 1
+
+    def stepRates(self):
+        #measured MD steps per second of the nodes that are alive
+        return [ self.step_rate[node] for node in range(self.nprocs)
+                 if self.node_status[node] is None or self.node_status[node] >= 0 ]
+
+    def setSegmentScaling(self, scale_segments):
+        #if True the number of MD steps of the segments launched on each node
+        #is scaled with the speed of the node relative to the average speed of
+        #the nodes, so that segments complete in similar wall-clock times
+        self.scale_segments = scale_segments
+
+    def _segmentSteps(self, nodeid, job):
+        #number of MD steps of a segment of job on the node, a multiple of the
+        #output frequency, of the trajectory frequency unless frames are
+        #written every few segments, and of the number of chunks of the segment
+        nsteps = job['nsteps']
+        if not self.scale_segments or self.step_rate[nodeid] is None:
+            return nsteps
+        rates = [rate for rate in self.stepRates() if rate is not None]
+        ntrj = job['ntrj'] if nsteps % job['ntrj'] == 0 else 1
+        unit = np.lcm.reduce([job['nprnt'], ntrj, job.get('nchunks', 1)])
+        scaled = nsteps*self.step_rate[nodeid]/np.mean(rates)
+        return int(unit*max(1, int(round(scaled/unit))))
+
+    def segmentTimes(self):
+        #measured segment durations of the nodes that are alive
+        return [ self.segment_time[node] for node in range(self.nprocs)
+                 if self.node_status[node] is None or self.node_status[node] >= 0 ]
+
+    def setDeadline(self, deadline, default_segment_time):
+        #Jobs are launched only on nodes expected to complete them by deadline.
+        #default_segment_time is the expected duration of a segment until measured.
+        self.deadline = deadline
+        self.default_segment_time = default_segment_time
+
+    def _expectedSegmentTime(self, nodeid):
+        if self.segment_time[nodeid] is not None:
+            return self.segment_time[nodeid]
+        measured = [t for t in self.segment_time if t is not None]
+        if len(measured) > 0:
+            return max(measured)
+        return self.default_segment_time
+
+    def _canComplete(self, nodeid):
+        #True if a segment launched now on the node is expected to complete before the deadline
+        #allowing for 10% fluctuations of the segment duration
+        if self.deadline is None:
+            return True
+        return time.time() + 1.1*self._expectedSegmentTime(nodeid) < self.deadline
+
+    def canLaunch(self):
+        #True if any node alive, or being restarted, could complete a
+        #segment before the deadline
+        return any([self._canComplete(node) for node in range(self.nprocs)
+                    if self.node_status[node] is None or self.node_status[node] >= 0
+                    or not self.disabled[node]])
+
+    def _availableNodes(self):
+        #returns the available nodes that can complete a segment before the deadline
+        return [node for node in range(self.nprocs)
+                if self.node_status[node] is None and self._canComplete(node)]
+
+    def _nextLaunch(self):
+        #returns the fastest available node for which a job is ready, nodes
+        #not yet measured first and ties broken at random, and the replica of
+        #the next job to run on it
+        available = self._availableNodes()
+        available = [available[i] for i in self.rng.permutation(len(available))]
+        available.sort(key = lambda node: -np.inf if self.step_rate[node] is None else -self.step_rate[node])
+        for node in available:
+            replica = self._nextJob(node)
+            if replica is not None:
+                return (node, replica)
+        return (None, None)
+
+    def setStateEnergies(self, parameter_sets, groups = None):
+        #requests the evaluation of the energies of each replica with each
+        #of the parameter sets at the end of its segments
+        self.state_energy_parameters = parameter_sets
+        self.state_energy_groups = groups
 
     def launchJob(self, replica, job_info):
         #Enqueues a replica for running based on provided job info.
+        #Jobs are launched in order of increasing job_info['priority'] (0 by
+        #default), and in order of submission at equal priority. A node
+        #preferably runs the first job whose job_info['affinity'] is that
+        #node, by default the node on which the replica has last run.
+        #Returns the number of jobs in the queue.
         job = job_info
         job['replica'] = replica
         job['start_time'] = 0
+        if job.get('affinity') is None:
+            if self.cached_on[replica] is not None:
+                job['affinity'] = self.cached_on[replica]
+            else:
+                job['affinity'] = self.replica_node[replica]
         self.replica_to_job[replica] = job
-        self.jobqueue.put(replica)
-        return self.jobqueue.qsize()
+        bisect.insort(self.jobqueue, (job.get('priority', 0), next(self._jobsequence), replica))
+        return len(self.jobqueue)
+
+    def _nextJob(self, node):
+        #removes from the queue and returns the replica of the next job to
+        #run on node, None if no job can run on it. A replica whose current
+        #coordinates are cached by a busy worker waits for that worker.
+        ready = [i for i, (priority, sequence, replica) in enumerate(self.jobqueue)
+                 if not self.posvel_stale[replica] or self.cached_on[replica] == node
+                 or self.node_status[self.cached_on[replica]] is None]
+        if len(ready) == 0:
+            return None
+        for i in ready:
+            if self.replica_to_job[self.jobqueue[i][2]]['affinity'] == node:
+                return self.jobqueue.pop(i)[2]
+        return self.jobqueue.pop(ready[0])[2]
 
     def LaunchReplica(self, worker, replica, cycle, nsteps,
-                      nheating = 0, ncooling = 0, hightemp = 0.0):
+                      nheating = 0, ncooling = 0, hightemp = 0.0,
+                      nchunks = 1, state_moves = None, recovery = False):
+        #the coordinates of the replica are set by _setReplicaPosVel()
         (stateid, par) = replica.get_state()
-        worker.set_posvel(replica.positions, replica.velocities)
-        worker.set_state(par)
-        worker.run(nsteps, nheating, ncooling, hightemp)
-
-    def ProcessJobQueue(self, mintime, maxtime):
-        #Launches jobs waiting in the queue.
-        #It will scan free devices and job queue up to maxtime.
-        #If the queue becomes empty, it will still block until maxtime is elapsed.
+        worker.set_state(stateid)
+        seed = None
+        if state_moves is not None:
+            #the worker draws the state moves from a generator seeded from ours
+            seed = int(self.rng.integers(2**32))
+        worker.run(nsteps, nheating, ncooling, hightemp, nchunks, state_moves, seed, recovery)
+
+    def _setReplicaPosVel(self, node, replica):
+        #sets the coordinates of the context of the worker of node to those
+        #of replica, from the cache of the worker if it holds them
+        worker = self.openmm_workers[node]
+        ommreplica = self.openmm_replicas[replica]
+        if self.cached_on[replica] == node:
+            worker.restore_posvel(replica, self._velocityScale(ommreplica))
+            return
+        if self.posvel_stale[replica]:
+            #the replica migrates from the idle worker that holds its coordinates
+            self._fetchReplica(replica)
+        worker.set_posvel(ommreplica.positions, ommreplica.velocities)
+
+    def _launchQueuedJobs(self):
+        #Launches jobs waiting in the queue on the available nodes
         njobs_launched = 0
-        usetime = 0
-        nreplicas = len(self.replica_to_job)
 
-        while usetime < maxtime:
-            # find an available node
-            node = self._availableNode()
+        # find an available node and the next job to run on it
+        (node, replica) = self._nextLaunch()
+
+        while node is not None:
+
+            job = self.replica_to_job[replica]
 
-            while (not self.jobqueue.empty()) and (not node == None):
+            # assign job to available node
+            job['nodeid'] = node
+            job['openmm_replica'] = self.openmm_replicas[replica]
+            job['openmm_worker'] = self.openmm_workers[node]
+            job['start_time'] = time.time()
+
+            # connects node to replica
+            self.replica_to_job[replica] = job
+            self.node_status[node] = replica
+            self.replica_node[replica] = node
+
+            if 'nheating' in job:
+                nheating = job['nheating']
+                ncooling = job['ncooling']
+                hightemp = job['hightemp']
+            else:
+                nheating = 0
+                ncooling = 0
+                hightemp = 0.0
 
-                # grabs job on top of the queue
-                replica = self.jobqueue.get()
-                job = self.replica_to_job[replica]
+            job['nsteps'] = self._segmentSteps(node, job)
+            self._setReplicaPosVel(node, replica)
+            self.segment_failed[replica] = False
+            self.LaunchReplica(job['openmm_worker'], job['openmm_replica'], job['cycle'],
+                               job['nsteps'], nheating, ncooling, hightemp,
+                               job.get('nchunks', 1), job.get('state_moves'),
+                               self.recovery_attempts[replica] > 0)
 
-                # assign job to available node
-                job['nodeid'] = node
-                job['openmm_replica'] = self.openmm_replicas[replica]
-                job['openmm_worker'] = self.openmm_workers[node]
-                job['start_time'] = time.time()
+            # updates number of jobs launched
+            njobs_launched += 1
 
-                # connects node to replica
-                self.replica_to_job[replica] = job
-                self.node_status[node] = replica
+            if len(self.jobqueue) == 0:
+                break
+            (node, replica) = self._nextLaunch()
 
-                if 'nheating' in job:
-                    nheating = job['nheating']
-                    ncooling = job['ncooling']
-                    hightemp = job['hightemp']
-                else:
-                    nheating = 0
-                    ncooling = 0
-                    hightemp = 0.0
+        return njobs_launched
 
-                self.LaunchReplica(job['openmm_worker'], job['openmm_replica'], job['cycle'],
-                                   job['nsteps'], nheating, ncooling, hightemp)
+    def waitForCompletion(self, timeout):
+        """
+        Blocks until a busy node signals the end of a run or the death of its
+        worker process, or until timeout seconds have elapsed.
 
-                # updates number of jobs launched
-                njobs_launched += 1
+        Returns the set of node ids that woke up.
+        """
+        handles = {}
+        for nodeid in range(self.nprocs):
+            if self.node_status[nodeid] is not None and self.node_status[nodeid] >= 0:
+                worker = self.openmm_workers[nodeid]
+                handles[worker.completion_connection()] = nodeid
+                handles[worker.sentinel()] = nodeid
+        if any(thread is not None for thread in self.restarting):
+            #a node coming back from a restart wakes up the wait too
+            handles[self._wakeup_recv] = None
+
+        wait_start_time = time.time()
+
+        if len(handles) == 0:
+            #nothing is running, nothing to wait for
+            if timeout > 0:
+                time.sleep(timeout)
+            self.wait_time += time.time() - wait_start_time
+            return set()
+
+        ready = mp.connection.wait(list(handles), max(0, timeout))
+        self.wait_time += time.time() - wait_start_time
+
+        nodes = set()
+        for handle in ready:
+            nodeid = handles[handle]
+            if nodeid is None:
+                while self._wakeup_recv.poll():
+                    nodes.add(self._wakeup_recv.recv())
+                continue
+            self.openmm_workers[nodeid].clear_notifications()
+            nodes.add(nodeid)
+        return nodes
+
+    def ProcessJobQueue(self, mintime, maxtime):
+        #Launches jobs waiting in the queue.
+        #It will scan free devices and job queue up to maxtime, waking up
+        #as soon as a worker signals that it has completed a run.
+        #Returns as soon as one or more replicas have completed, so that the
+        #caller can exchange and relaunch them without delay.
+        #mintime is the longest time spent waiting without checking for crashed nodes.
+        njobs_launched = 0
+        start_time = time.time()
 
-                node = self._availableNode()
+        while True:
+            njobs_launched += self._launchQueuedJobs()
 
-            # waits mintime second and rescans job queue
-            time.sleep(mintime)
+            remaining = maxtime - (time.time() - start_time)
+            if remaining <= 0:
+                break
+
+            # waits for a completion event or mintime seconds
+            nodes = self.waitForCompletion(min(mintime, remaining))
 
             # updates set of free nodes by checking for replicas that have exited
-            for repl in range(nreplicas):
-                self.isDone(repl,0)
+            ncompleted = 0
+            for nodeid in nodes:
+                replica = self.node_status[nodeid]
+                if replica is not None and replica >= 0:
+                    if self.isDone(replica,0):
+                        ncompleted += 1
 
             #restarts crashed nodes if any
             self._fixnodes()
 
-            usetime += mintime
+            if ncompleted > 0:
+                break
 
         return njobs_launched
 
     def DrainJobQueue(self):
         #clear the job queue
-        while not self.jobqueue.empty():
+        #returns the list of replicas removed from the queue
+        drained = []
+        while len(self.jobqueue) > 0:
             # grabs job on top of the queue
-            replica = self.jobqueue.get()
+            replica = self.jobqueue.pop(0)[2]
             self._clear_resource(replica)
             self.replica_to_job[replica] = None
+            drained.append(replica)
+        return drained
 
     def _update_replica(self, job):
         #update replica cycle, mdsteps, write out, etc. from worker
+        #returns 0 on success, 1 if the replica has blown up (NaN coordinates
+        #or energies) and None if the worker has failed
         ommreplica = job['openmm_replica']
-        if job['openmm_worker'].has_crashed(): #refuses to update replica from a crashed worker
+        worker = job['openmm_worker']
+        if worker.has_crashed(): #refuses to update replica from a crashed worker
             return None
-        (pos,vel) = job['openmm_worker'].get_posvel()
-        pot = job['openmm_worker'].get_energy()
-        if pos is None or vel is None or pot is None:
+        if worker.has_blown_up():
+            return 1
+        mdsteps = ommreplica.get_mdsteps() + job['nsteps']
+        #a trajectory frame is due if the segment has reached a multiple of
+        #the trajectory frequency, with a cache the coordinates stay in the
+        #worker otherwise
+        frame = mdsteps // job['ntrj'] > (mdsteps - job['nsteps']) // job['ntrj']
+        fetch = worker.cache_size <= 0 or frame
+        if fetch:
+            (pos,vel) = worker.get_posvel()
+            if pos is None or vel is None:
+                return None
+        pot = worker.get_energy()
+        if pot is None:
             return None
         for value in pot.values():
             if math.isnan(value._value):
-                return None
-        for p in pos:
-            if math.isnan(p.x) or math.isnan(p.y) or math.isnan(p.z):
-                return None
-        for v in vel:
-            if math.isnan(v.x) or math.isnan(v.y) or math.isnan(v.z):
-                return None
+                return 1
+        if self.state_energy_parameters is not None:
+            #energies of the final configuration in each state
+            state_energies = job['openmm_worker'].get_energies(self.state_energy_parameters,
+                                                               self.state_energy_groups)
+            if np.any(np.isnan(state_energies)):
+                return 1
+            pot['state_energies'] = state_energies
+        if fetch:
+            for p in pos:
+                if math.isnan(p.x) or math.isnan(p.y) or math.isnan(p.z):
+                    return 1
+            for v in vel:
+                if math.isnan(v.x) or math.isnan(v.y) or math.isnan(v.z):
+                    return 1
+        if job.get('state_moves') is not None:
+            #the replica ends the run in the last state it has moved to,
+            #see openmm_job._applyStateMoves()
+            trajectory = job['openmm_worker'].get_state_trajectory()
+            if len(trajectory) > 0 and trajectory[-1] != ommreplica.stateid:
+                ommreplica.set_state(trajectory[-1], job['openmm_worker'].state_table[trajectory[-1]])
+            ommreplica.state_trajectory = trajectory
+        if not fetch and not self.posvel_stale[ommreplica._id]:
+            #the replica object keeps the coordinates of its previous segment
+            self.posvel_record[ommreplica._id] = (ommreplica.get_cycle(), ommreplica.get_mdsteps(),
+                                                  ommreplica.get_energy())
         cycle = ommreplica.get_cycle() + 1
         ommreplica.set_cycle(cycle)
-        mdsteps = ommreplica.get_mdsteps() + job['nsteps']
         ommreplica.set_mdsteps(mdsteps)
         #update positions and velocities of openmm replica
-        ommreplica.set_posvel(pos,vel)
+        if fetch:
+            ommreplica.set_posvel(pos,vel)
+        if worker.cache_size > 0:
+            self._cacheReplica(job['nodeid'], ommreplica._id)
+        self.posvel_stale[ommreplica._id] = not fetch
 
         #TODO: should also update boxsize
         #update energies of openmm replica
-        ommreplica.set_energy(pot)
+        ommreplica.set_energy(pot, worker.par)
         #output data and trajectory file update 
         if mdsteps % job['nprnt'] == 0:
             ommreplica.save_out()
-        if mdsteps % job['ntrj'] == 0:
+        if frame:
             ommreplica.save_dcd()
         return 0
 
+    def segmentFailed(self, replica):
+        #True if the last segment of the replica has failed, it has then
+        #to be run again from its previous coordinates
+        return self.segment_failed[replica]
+
+    def replicaStopped(self, replica):
+        #True if the replica has blown up too many times to be run again
+        return self.replica_stopped[replica]
+
     def isDone(self,replica,cycle):
         """
         Checks if a replica completed a run.
@@ -253,6 +665,8 @@ class LocalOpenMMTransport(Transport):
                 self.logger.warning("isDone(): replica %d has crashed", replica)
                 openmm_worker.finish(wait = False)
                 self.node_status[job['nodeid']] = -1 #signals dead context
+                self._dropCache(job['nodeid'])
+                self.segment_failed[replica] = True
                 self._clear_resource(replica)
                 self.replica_to_job[replica] = None
                 return True
@@ -265,12 +679,35 @@ class LocalOpenMMTransport(Transport):
             if done:
                 #update replica info
                 retcode = self._update_replica(job)
-                if retcode is None:
+                if retcode == 1 and self.recovery_attempts[replica] < openmm_worker.max_recovery_attempts:
+                    #the replica has blown up but the worker is fine, the
+                    #replica is run again from its last good coordinates
+                    self.recovery_attempts[replica] += 1
+                    self.segment_failed[replica] = True
+                    self.logger.warning("isDone(): replica %d has blown up, recovery attempt %d", replica,
+                                        self.recovery_attempts[replica])
+                elif retcode == 1:
+                    #the worker is fine, the replica is not run again and keeps
+                    #its last good coordinates
+                    self.logger.error("isDone(): replica %d has blown up %d times in a row, it is stopped", replica,
+                                      self.recovery_attempts[replica] + 1)
+                    self.segment_failed[replica] = True
+                    self.replica_stopped[replica] = True
+                elif retcode is None:
                     self.logger.warning("isDone(): replica %d has completed with errors", replica)
+                    openmm_worker.finish(wait = False)
                     self.node_status[job['nodeid']] = -1 #signals dead context
+                    self._dropCache(job['nodeid'])
+                    self.segment_failed[replica] = True
+                    self.recovery_attempts[replica] = 0
+                else:
+                    self.recovery_attempts[replica] = 0
+                    self._recordSegmentTime(job['nodeid'], time.time() - job['start_time'], job['nsteps'])
                 # disconnects replica from job and node
                 self._clear_resource(replica)
                 #flag replica as not linked to a job
                 self.replica_to_job[replica] = None
+                if self.node_status[job['nodeid']] is None and len(self.sync_pending) > 0:
+                    self._syncPending(job['nodeid'])
 
             return done
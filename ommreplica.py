@@ -29,6 +29,13 @@ class OMMReplica(object):
         self.par = None
         self.cycle = 1
         self.stateid = None
+        #states visited during the last segment with local state moves
+        self.state_trajectory = []
+        #state in which the energies were computed, and a counter of the
+        #updates of the energies
+        self.energy_stateid = None
+        self.energy_par = None
+        self.energy_version = 0
         self.mdsteps = 0
         self.outfile = None
 
@@ -45,19 +52,40 @@ class OMMReplica(object):
         self.open_dcd()
 
     def set_state(self, stateid, par):
-        self.stateid = int(stateid)
-        self.par = copy.deepcopy(par)
+        #returns True if the state assignment has changed
+        #par is the row of the job's state table for stateid
+        #the context of the service worker is updated from the replica
+        #only when saving a checkpoint
+        stateid = int(stateid)
+        if self.energy_par is None and stateid == self.energy_stateid:
+            #energies loaded from a checkpoint
+            self.energy_par = par.copy()
+        if stateid == self.stateid and self.par is not None:
+            return False
+        self.stateid = stateid
+        self.par = par
         self.is_state_assigned = True
-        self.update_context_from_state()
-        
+        return True
+
     def get_state(self):
         return (self.stateid, self.par)
 
     def get_energy(self):
         return self.pot
 
-    def set_energy(self, pot):
+    def set_energy(self, pot, par = None):
+        #par are the parameters of the state the energies were computed
+        #in if they may differ from the current parameters of the state
         self.pot = copy.deepcopy(pot)
+        self._energy_updated(par)
+
+    def _energy_updated(self, par = None):
+        #the energies are computed in the state the replica has run in
+        self.energy_stateid = self.stateid
+        if par is None and self.par is not None:
+            par = self.par.copy()
+        self.energy_par = par
+        self.energy_version += 1
         
     def set_posvel(self, positions, velocities):
         self.positions = copy.deepcopy(positions)
@@ -76,9 +104,16 @@ class OMMReplica(object):
             self.worker.simulation.loadState(ckptfile)
             self.update_state_from_context()
 
-    def save_checkpoint(self):
+    def save_checkpoint(self, record = None):
+        #record is the (cycle, mdsteps, energies) that go with the coordinates
+        #of the replica if these are older than its last segment
         ckptfile = 'r%d/%s_ckpt.xml' % (self._id,self.basename)
+        if record is not None:
+            current = (self.cycle, self.mdsteps, self.pot)
+            (self.cycle, self.mdsteps, self.pot) = record
         self.update_context_from_state()
+        if record is not None:
+            (self.cycle, self.mdsteps, self.pot) = current
         self.worker.simulation.saveState(ckptfile)
         
     def open_dcd(self):
@@ -120,18 +155,19 @@ class OMMReplicaTRE(OMMReplica):
             pot_energy = self.pot['potential_energy']
             temperature = self.par['temperature']
             if self.outfile is not None:
-                self.outfile.write("%d %f %f\n" % (self.stateid, temperature, pot_energy))
+                self.outfile.write("%d %f %f\n" % (self.stateid, temperature, pot_energy/kilocalories_per_mole))
 
     def update_state_from_context(self):
         self.cycle = int(self.context.getParameter(self.ommsystem.parameter['cycle']))
         self.stateid = int(self.context.getParameter(self.ommsystem.parameter['stateid']))
         self.mdsteps = int(self.context.getParameter(self.ommsystem.parameter['mdsteps']))
-        if self.par is None:
-            self.par = {}
-        self.par['temperature'] = self.context.getParameter(self.ommsystem.parameter['temperature'])*kelvin
+        #the state parameters are set by the job from its state table
         if self.pot is None:
             self.pot = {}
         self.pot['potential_energy'] = self.context.getParameter(self.ommsystem.parameter['potential_energy'])*kilojoules_per_mole
+        #the checkpoint does not record the state of the energies, assume
+        #the replica has not been exchanged since it last ran
+        self._energy_updated()
         state = self.context.getState(getPositions=True, getVelocities=True)
         self.positions = state.getPositions()
         self.velocities = state.getVelocities()
@@ -140,9 +176,9 @@ class OMMReplicaTRE(OMMReplica):
         self.context.setParameter(self.ommsystem.parameter['cycle'], self.cycle)
         self.context.setParameter(self.ommsystem.parameter['stateid'], self.stateid)
         self.context.setParameter(self.ommsystem.parameter['mdsteps'], self.mdsteps)
-        if self.par is None:
-            self.context.setParameter(self.ommsystem.parameter['temperature'], self.par['temperature']/kelvin)
-        if self.pot is None:
+        if self.par is not None:
+            self.context.setParameter(self.ommsystem.parameter['temperature'], float(self.par['temperature']))
+        if self.pot is not None:
             self.context.setParameter(self.ommsystem.parameter['potential_energy'], self.pot['potential_energy']/kilojoules_per_mole)
 
 class OMMReplicaATM(OMMReplica):
@@ -151,15 +187,17 @@ class OMMReplicaATM(OMMReplica):
             pot_energy = self.pot['potential_energy']
             pert_energy = self.pot['perturbation_energy']
             bias_energy = self.pot['bias_energy']
-            temperature = self.par['temperature']
-            lmbd1 = self.par['lambda1']
-            lmbd2 = self.par['lambda2']
-            alpha = self.par['alpha']
-            u0 = self.par['u0']
-            w0 = self.par['w0']
-            direction = self.par['atmdirection']
+            #the parameters, such as an adaptive w0, the energies were computed with
+            par = self.energy_par if self.energy_par is not None else self.par
+            temperature = par['temperature']
+            lmbd1 = par['lambda1']
+            lmbd2 = par['lambda2']
+            alpha = par['alpha']
+            u0 = par['u0']
+            w0 = par['w0']
+            direction = par['atmdirection']
             if self.outfile is not None:
-                self.outfile.write("%d %f %f %f %f %f %f %f %f %f %f\n" % (self.stateid, temperature/kelvin, direction, lmbd1, lmbd2, alpha*kilocalories_per_mole, u0/kilocalories_per_mole, w0/kilocalories_per_mole, pot_energy/kilocalories_per_mole, pert_energy/kilocalories_per_mole, bias_energy/kilocalories_per_mole))
+                self.outfile.write("%d %f %f %f %f %f %f %f %f %f %f\n" % (self.stateid, temperature, direction, lmbd1, lmbd2, (alpha/kilojoules_per_mole)*kilocalories_per_mole, (u0*kilojoules_per_mole)/kilocalories_per_mole, (w0*kilojoules_per_mole)/kilocalories_per_mole, pot_energy/kilocalories_per_mole, pert_energy/kilocalories_per_mole, bias_energy/kilocalories_per_mole))
                 self.outfile.flush()
             else:
                 self.logger.warning("unable to save output")
@@ -170,21 +208,15 @@ class OMMReplicaATM(OMMReplica):
         self.cycle = int(self.context.getParameter(self.ommsystem.parameter['cycle']))
         self.stateid = int(self.context.getParameter(self.ommsystem.parameter['stateid']))
         self.mdsteps = int(self.context.getParameter(self.ommsystem.parameter['mdsteps']))
-        if self.par is None:
-            self.par = {}
-        self.par['temperature'] = self.context.getParameter(self.ommsystem.parameter['temperature'])*kelvin
-        self.par['lambda1'] = self.context.getParameter(self.ommsystem.atmforce.Lambda1())
-        self.par['lambda2'] = self.context.getParameter(self.ommsystem.atmforce.Lambda2())
-        self.par['alpha'] = self.context.getParameter(self.ommsystem.atmforce.Alpha())/kilojoules_per_mole
-        self.par['u0'] = self.context.getParameter(self.ommsystem.atmforce.U0())*kilojoules_per_mole
-        self.par['w0'] = self.context.getParameter(self.ommsystem.atmforce.W0())*kilojoules_per_mole
-        self.par['atmdirection'] = self.context.getParameter(self.ommsystem.atmforce.Direction())
-        self.par['atmintermediate'] = self.context.getParameter(self.ommsystem.parameter['atmintermediate'])
+        #the state parameters are set by the job from its state table
         if self.pot is None:
             self.pot = {}
         self.pot['potential_energy'] = self.context.getParameter(self.ommsystem.parameter['potential_energy'])*kilojoules_per_mole
         self.pot['perturbation_energy'] = self.context.getParameter(self.ommsystem.parameter['perturbation_energy'])*kilojoules_per_mole
         self.pot['bias_energy'] = self.context.getParameter(self.ommsystem.parameter['bias_energy'])*kilojoules_per_mole
+        #the checkpoint does not record the state of the energies, assume
+        #the replica has not been exchanged since it last ran
+        self._energy_updated()
         state = self.context.getState(getPositions=True, getVelocities=True)
         self.positions = state.getPositions()
         self.velocities = state.getVelocities()
@@ -194,14 +226,14 @@ class OMMReplicaATM(OMMReplica):
         self.context.setParameter(self.ommsystem.parameter['stateid'], self.stateid)
         self.context.setParameter(self.ommsystem.parameter['mdsteps'], self.mdsteps)
         if self.par is not None:
-            self.context.setParameter(self.ommsystem.parameter['temperature'], self.par['temperature']/kelvin)
-            self.context.setParameter(self.ommsystem.atmforce.Lambda1(), self.par['lambda1'])
-            self.context.setParameter(self.ommsystem.atmforce.Lambda2(), self.par['lambda2'])
-            self.context.setParameter(self.ommsystem.atmforce.Alpha(), self.par['alpha']*kilojoules_per_mole)
-            self.context.setParameter(self.ommsystem.atmforce.U0(), self.par['u0']/kilojoules_per_mole)
-            self.context.setParameter(self.ommsystem.atmforce.W0(), self.par['w0']/kilojoules_per_mole)
-            self.context.setParameter(self.ommsystem.atmforce.Direction(), self.par['atmdirection'])
-            self.context.setParameter(self.ommsystem.parameter['atmintermediate'], self.par['atmintermediate'])
+            self.context.setParameter(self.ommsystem.parameter['temperature'], float(self.par['temperature']))
+            self.context.setParameter(self.ommsystem.atmforce.Lambda1(), float(self.par['lambda1']))
+            self.context.setParameter(self.ommsystem.atmforce.Lambda2(), float(self.par['lambda2']))
+            self.context.setParameter(self.ommsystem.atmforce.Alpha(), float(self.par['alpha']))
+            self.context.setParameter(self.ommsystem.atmforce.U0(), float(self.par['u0']))
+            self.context.setParameter(self.ommsystem.atmforce.W0(), float(self.par['w0']))
+            self.context.setParameter(self.ommsystem.atmforce.Direction(), float(self.par['atmdirection']))
+            self.context.setParameter(self.ommsystem.parameter['atmintermediate'], float(self.par['atmintermediate']))
         if self.pot is not None:
             self.context.setParameter(self.ommsystem.parameter['potential_energy'], self.pot['potential_energy']/kilojoules_per_mole)
             self.context.setParameter(self.ommsystem.parameter['perturbation_energy'], self.pot['perturbation_energy']/kilojoules_per_mole)
@@ -4,9 +4,12 @@ from __future__ import division
 Multiprocessing job transport for AsyncRE/OpenMM
 """
 import os, re, sys, time, shutil, copy, random, signal
+import collections
+import threading
 import multiprocessing as mp
 #from multiprocessing import Process, Queue, Event
 import logging
+import numpy as np
 
 from simtk import openmm as mm
 from simtk.openmm.app import *
@@ -19,6 +22,22 @@ from ommsystem import *
 
 from contextlib import contextmanager
 
+def _softplus_array(lambda1, lambda2, alpha, u0, w0, uf):
+    """
+    Vectorized version of the softplus alchemical potential
+
+    lambda2*uf + w0 + ((lambda2 - lambda1)/alpha)*log(1 + exp(-alpha*(uf - u0)))
+
+    with energies in kJ/mol and alpha in mol/kJ. The logarithmic term is
+    evaluated with logaddexp to avoid overflows and it is omitted where
+    alpha = 0. Arguments are NumPy arrays or scalars that broadcast together.
+    """
+    softplusf = lambda2 * uf + w0
+    active = alpha > 0.
+    safe_alpha = np.where(active, alpha, 1.0)
+    softplusf = softplusf + np.where(active, ((lambda2 - lambda1)/safe_alpha) * np.logaddexp(0., -safe_alpha*(uf - u0)), 0.)
+    return softplusf
+
 class OMMWorker(object):
     # OpenMM worker to run a replica in a process controlling one device
     #
@@ -28,6 +47,7 @@ class OMMWorker(object):
     #  get_energy_values()
     #  _worker_setstate_fromqueue()
     #  _worker_getenergy()
+    #  _worker_statemove()
     #  _openmm_worker_body()
     def __init__(self, basename, ommsystem, keywords, node_info = None, compute = True, logger = None):
         self.node_name = None
@@ -48,6 +68,34 @@ class OMMWorker(object):
         self.ommsystem = ommsystem
         self.compute = compute
         self.logger = logger
+        #table of state parameters indexed by state id, see set_state_table()
+        self.state_table = None
+        self._state_table_sent = False
+        #copy of the table last sent to the worker, the job may change its
+        #table while the worker runs
+        self._worker_state_table = None
+        #number of replicas whose coordinates, velocities and box the worker
+        #keeps, see cache_posvel()
+        if self.keywords.get('WORKER_REPLICA_CACHE') is None:
+            self.cache_size = 0
+        else:
+            self.cache_size = int(self.keywords.get('WORKER_REPLICA_CACHE'))
+        #a replica that blows up is run again from its last coordinates up to
+        #MAX_RECOVERY_ATTEMPTS times before it is stopped, with the
+        #MD step size scaled by RECOVERY_TIMESTEP_SCALE and after up to
+        #RECOVERY_MINIMIZATION_STEPS steps of energy minimization
+        if self.keywords.get('MAX_RECOVERY_ATTEMPTS') is None:
+            self.max_recovery_attempts = 2
+        else:
+            self.max_recovery_attempts = int(self.keywords.get('MAX_RECOVERY_ATTEMPTS'))
+        if self.keywords.get('RECOVERY_TIMESTEP_SCALE') is None:
+            self.recovery_timestep_scale = 1.0
+        else:
+            self.recovery_timestep_scale = float(self.keywords.get('RECOVERY_TIMESTEP_SCALE'))
+        if self.keywords.get('RECOVERY_MINIMIZATION_STEPS') is None:
+            self.recovery_minimization_steps = 0
+        else:
+            self.recovery_minimization_steps = int(self.keywords.get('RECOVERY_MINIMIZATION_STEPS'))
         self.start_worker()
 
     def start_worker(self):
@@ -56,9 +104,12 @@ class OMMWorker(object):
         self._readySignal = self.ctx.Event()
         self._runningSignal = self.ctx.Event()
         self._errorSignal = self.ctx.Event()
+        self._blowupSignal = self.ctx.Event()
         self._cmdq = self.ctx.Queue()
         self._inq = self.ctx.Queue()
         self._outq = self.ctx.Queue()
+        #the worker notifies the end of a run through this pipe
+        self._notify_recv, self._notify_send = self.ctx.Pipe(duplex=False)
         self.simulation = None
         self.context = None
         self.atmforce = None
@@ -66,18 +117,34 @@ class OMMWorker(object):
         self.boxvectors = None
         self.par = {}
         self.pot = {}
+        self.stateid = None
+        #ids of the states visited by the replica during the last run
+        self.state_trajectory = []
         self.platform = None
         self.logfile_p = None
         self.outfile_p = None
         self.nprnt = int(self.keywords.get('PRNT_FREQUENCY'))
+        #ids of the replicas in the cache of the worker, least recently used first
+        self.cached_replicas = collections.OrderedDict()
         if self.compute:
             #compute workers are launched as subprocesses
-            s = signal.signal(signal.SIGINT, signal.SIG_IGN) #so that children do not respond to ctrl-c
+            #workers may be restarted from a supervisor thread, where signal
+            #handlers cannot be set; the worker then ignores ctrl-c itself
+            main_thread = threading.current_thread() is threading.main_thread()
+            if main_thread:
+                s = signal.signal(signal.SIGINT, signal.SIG_IGN) #so that children do not respond to ctrl-c
             self._p = self.ctx.Process(target=self.openmm_worker)
             self._p.daemon = True
-            signal.signal(signal.SIGINT, s) #restore signal before start() of children
+            if main_thread:
+                signal.signal(signal.SIGINT, s) #restore signal before start() of children
             self._p.start()
-            self._readySignal.wait()
+            #returns None if the worker dies before it is ready
+            while not self._readySignal.wait(1.0):
+                if not self._p.is_alive():
+                    self.logger.error("worker has died during startup")
+                    return None
+            #a restarted worker needs the table of states again
+            self._state_table_sent = False
             return self._p
         else:
             #the service worker needs only the context in this process
@@ -85,10 +152,24 @@ class OMMWorker(object):
             self._openmm_worker_makecontext()
             return 1
 
-    def set_state(self, par):
+    def set_state_table(self, state_table):
+        #sets the table of state parameters, states are then set by id
+        #the table is sent to the worker with the next state assignment,
+        #call again when the table changes
+        self.state_table = state_table
+        self._state_table_sent = False
+
+    def set_state(self, stateid):
         self._readySignal.wait()
+        if not self._state_table_sent:
+            self._worker_state_table = self.state_table.copy()
+            self._cmdq.put("SETSTATETABLE")
+            self._inq.put(self._worker_state_table)
+            self._state_table_sent = True
         self._cmdq.put("SETSTATE")
-        self._inq.put(par)
+        self._inq.put(int(stateid))
+        #the parameters of the state the worker runs in
+        self.par = self._worker_state_table[stateid].copy()
 
     def get_energy(self):
         self._startedSignal.wait()
@@ -97,6 +178,26 @@ class OMMWorker(object):
         pot = self._outq.get()
         return pot
 
+    # energies of the current configuration under a batch of parameter sets
+    def get_energies(self, parameter_sets, groups = None):
+        """
+        Returns the array of the potential energies in kJ/mol of the current
+        configuration with the global parameters of the context set to each
+        of the parameter sets in turn. parameter_sets is a structured array
+        whose field names are the names of the context parameters; groups is
+        the optional set of force groups to evaluate. The parameters of the
+        context are restored afterwards.
+        """
+        if not self.compute:
+            #the service worker evaluates the energies in this process
+            return self._worker_getenergies(parameter_sets, groups)
+        self._startedSignal.wait()
+        self._readySignal.wait()
+        self._cmdq.put("GETENERGIES")
+        self._inq.put(parameter_sets)
+        self._inq.put(groups)
+        return self._outq.get()
+
     # set positions and velocities of worker
     def set_posvel(self, positions, velocities):
         self._startedSignal.wait()
@@ -132,6 +233,7 @@ class OMMWorker(object):
             self._outq.get()
         self._inq.close()
         self._cmdq.close()
+        self._notify_recv.close()
         self._p.terminate()
         self._p.join(10) #10s time-out
         self._p.exitcode
@@ -148,15 +250,104 @@ class OMMWorker(object):
     def has_crashed(self):
         return not self._p.is_alive() or self._errorSignal.is_set()
 
+    # has the replica of the last run blown up? the worker remains usable
+    def has_blown_up(self):
+        return self._blowupSignal.is_set()
+
+    # connection that becomes readable when the worker completes a run
+    def completion_connection(self):
+        return self._notify_recv
+
+    # handle that becomes ready when the worker process exits
+    def sentinel(self):
+        return self._p.sentinel
+
+    # consumes pending completion notifications
+    def clear_notifications(self):
+        try:
+            while self._notify_recv.poll():
+                self._notify_recv.recv()
+        except (EOFError, OSError):
+            pass
+
+    # cache of replica coordinates kept by the worker process
+    #
+    # The coordinates, velocities and periodic box of up to cache_size
+    # replicas stay in the worker so that a replica relaunched on the same
+    # worker does not travel through the queues. The cache is managed by the
+    # controlling process: cached_replicas mirrors its content and entries
+    # are evicted only by uncache().
+    def cache_posvel(self, replica):
+        #stores the current coordinates of the context as those of replica
+        self._startedSignal.wait()
+        self._readySignal.wait()
+        self._cmdq.put("CACHEPOSVEL")
+        self._inq.put(replica)
+        self.cached_replicas[replica] = True
+        self.cached_replicas.move_to_end(replica)
+
+    def restore_posvel(self, replica, velocity_scale = 1.0):
+        #sets the coordinates of the context from the cache, scaling the velocities
+        self._startedSignal.wait()
+        self._readySignal.wait()
+        self._cmdq.put("RESTOREPOSVEL")
+        self._inq.put(replica)
+        self._inq.put(velocity_scale)
+        self.cached_replicas.move_to_end(replica)
+
+    def get_cached_posvel(self, replica):
+        #returns the cached positions and velocities of replica, waits for the
+        #end of the current run if any
+        self._startedSignal.wait()
+        self._readySignal.wait()
+        self._cmdq.put("GETCACHED")
+        self._inq.put(replica)
+        positions = self._outq.get()
+        velocities = self._outq.get()
+        return (positions, velocities)
+
+    def uncache(self, replica):
+        self._cmdq.put("UNCACHE")
+        self._inq.put(replica)
+        self.cached_replicas.pop(replica, None)
+
+    # ids of the states visited by the replica during the last run
+    def get_state_trajectory(self):
+        """
+        Returns the list of the ids of the states of the replica at the end of
+        each chunk of the last run with local state moves, empty otherwise.
+        The last one is the state of the replica at the end of the run.
+        """
+        self._startedSignal.wait()
+        self._readySignal.wait()
+        self._cmdq.put("GETSTATETRAJ")
+        trajectory = self._outq.get()
+        if len(trajectory) > 0:
+            self.par = self._worker_state_table[trajectory[-1]].copy()
+        return trajectory
+
     # starts execution loop of the worker
-    def run(self, nsteps, nheating = 0, ncooling = 0, hightemp = 0.0):
+    # with state_moves ('gibbs' or 'metropolis') the run is split in nchunks
+    # chunks separated by moves of the replica among the states, see
+    # _worker_statemove(), drawing random numbers from a generator seeded with seed
+    # recovery is True when the replica is run again after blowing up
+    def run(self, nsteps, nheating = 0, ncooling = 0, hightemp = 0.0,
+            nchunks = 1, state_moves = None, seed = None, recovery = False):
         self._startedSignal.wait()
         self._readySignal.wait()
+        #flag the worker as running right away so that a completion check
+        #issued before the worker picks up the command does not succeed
+        self._readySignal.clear()
+        self._runningSignal.set()
         self._cmdq.put("RUN")
         self._inq.put(nsteps)
         self._inq.put(nheating)
         self._inq.put(ncooling)
         self._inq.put(hightemp)
+        self._inq.put(nchunks)
+        self._inq.put(state_moves)
+        self._inq.put(seed)
+        self._inq.put(recovery)
 
     #
     # routine being multi-processed (worker)
@@ -173,18 +364,59 @@ class OMMWorker(object):
         self.boxvectors = self.ommsystem.boxvectors
         
     def _openmm_worker_run(self):
+        #returns 1 on success, 0 if the replica has blown up and None if MD
+        #has failed otherwise
+        #the periodic box is restored if the replica blows up
+        boxvectors = self.context.getState().getPeriodicBoxVectors()
+        stepsize = self.integrator.getStepSize()
         try:
+            if self.recovery:
+                if self.recovery_minimization_steps > 0:
+                    LocalEnergyMinimizer.minimize(self.context, maxIterations = self.recovery_minimization_steps)
+                self.integrator.setStepSize(self.recovery_timestep_scale*stepsize)
             if self.nheating > 0:
                 self.integrator.setTemperature(self.hightemp)
                 self.simulation.step(self.nheating)
                 self.simulation.step(self.ncooling)
-                production_temperature = self.par['temperature']
+                production_temperature = self.par['temperature']*kelvin
                 self.integrator.setTemperature(production_temperature)
-            self.simulation.step(self.nsteps)
+            self.state_trajectory = []
+            if self.state_moves is not None:
+                #expanded ensemble, the replica moves among the states in
+                #between chunks of the segment
+                nchunk_steps = self.nsteps // self.nchunks
+                for chunk in range(self.nchunks):
+                    self.simulation.step(nchunk_steps)
+                    self.state_trajectory.append(self._worker_statemove())
+            else:
+                self.simulation.step(self.nsteps)
             return 1
-        except:
+        except Exception as e:
+            if self._worker_blownup(e):
+                #the context is fine, only the replica has blown up
+                self.logger.warning("MD has blown up: %s" % e)
+                self.context.setPeriodicBoxVectors(*boxvectors)
+                return 0
             self.logger.error("MD has crashed")
             return None
+        finally:
+            if self.recovery:
+                self.integrator.setStepSize(stepsize)
+
+    def _worker_blownup(self, e):
+        #True if the MD exception e comes from the replica blowing up rather
+        #than from a failure of the context: OpenMM reports "Particle
+        #coordinate is NaN", otherwise the coordinates and the energy left in
+        #the context are checked
+        if 'particle coordinate is nan' in str(e).lower():
+            return True
+        try:
+            state = self.context.getState(getEnergy = True, getPositions = True)
+            positions = state.getPositions(asNumpy = True).value_in_unit(nanometer)
+            energy = state.getPotentialEnergy().value_in_unit(kilojoules_per_mole)
+        except Exception:
+            return False
+        return not (np.all(np.isfinite(positions)) and np.isfinite(energy))
 
     def _openmm_worker_makecontext(self):
         self.platform_properties = {}
@@ -242,6 +474,7 @@ class OMMWorker(object):
             self.simulation.reporters.append(StateDataReporter(self.logfile_p, self.nprnt, step=True, temperature=True))
 
     def openmm_worker(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
         try:
             import setproctitle
             setproctitle.setproctitle("AToM worker")
@@ -258,6 +491,7 @@ class OMMWorker(object):
         
         self.positions = None
         self.velocities = None
+        self.replica_cache = {}
 
         self.command = None
 
@@ -265,10 +499,10 @@ class OMMWorker(object):
         self._startedSignal.set()
         self._readySignal.set()
         while(True):
-            while(self._cmdq.empty()):
-                time.sleep(0.1)
             command = self._cmdq.get()
-            if command == "SETSTATE":
+            if command == "SETSTATETABLE":
+                self.state_table = self._inq.get()
+            elif command == "SETSTATE":
                 self._worker_setstate_fromqueue()
             elif command == "SETPOSVEL":
                 self.positions = self._inq.get()
@@ -283,8 +517,15 @@ class OMMWorker(object):
                 self.nheating = int(self._inq.get())
                 self.ncooling = int(self._inq.get())
                 self.hightemp = float(self._inq.get())
+                self.nchunks = int(self._inq.get())
+                self.state_moves = self._inq.get()
+                self.rng = np.random.default_rng(self._inq.get())
+                self.recovery = self._inq.get()
 
+                self._blowupSignal.clear()
                 res = self._openmm_worker_run()
+                if res == 0:
+                    self._blowupSignal.set()
 
                 if self.logfile_p is not None:
                     self.logfile_p.flush()
@@ -295,8 +536,32 @@ class OMMWorker(object):
                 if res is None:
                     self._errorSignal.set()
 
+                #wakes up the controlling process
+                self._notify_send.send(res is not None)
+
             elif command == "GETENERGY":
                 pot = self._worker_getenergy()
+            elif command == "CACHEPOSVEL":
+                replica = self._inq.get()
+                self.replica_cache[replica] = self.context.getState(getPositions=True, getVelocities=True)
+            elif command == "RESTOREPOSVEL":
+                state = self.replica_cache[self._inq.get()]
+                velocity_scale = self._inq.get()
+                self.context.setPeriodicBoxVectors(*state.getPeriodicBoxVectors())
+                self.context.setPositions(state.getPositions())
+                self.context.setVelocities(velocity_scale*state.getVelocities(asNumpy=True))
+            elif command == "GETCACHED":
+                state = self.replica_cache[self._inq.get()]
+                self._outq.put(state.getPositions())
+                self._outq.put(state.getVelocities())
+            elif command == "UNCACHE":
+                self.replica_cache.pop(self._inq.get(), None)
+            elif command == "GETSTATETRAJ":
+                self._outq.put(self.state_trajectory)
+            elif command == "GETENERGIES":
+                parameter_sets = self._inq.get()
+                groups = self._inq.get()
+                self._outq.put(self._worker_getenergies(parameter_sets, groups))
             elif command == "GETPOSVEL":
                 state = self.context.getState(getPositions=True, getVelocities=True)
                 self.positions = state.getPositions()
@@ -323,11 +588,35 @@ class OMMWorker(object):
         self._startedSignal.clear()
         self._readySignal.clear()
 
+    def _worker_getenergies(self, parameter_sets, groups):
+        context = self.simulation.context
+        names = parameter_sets.dtype.names
+        saved = [context.getParameter(name) for name in names]
+        energies = np.zeros(len(parameter_sets))
+        for i in range(len(parameter_sets)):
+            for name in names:
+                context.setParameter(name, float(parameter_sets[i][name]))
+            if groups is None:
+                state = context.getState(getEnergy = True)
+            else:
+                state = context.getState(getEnergy = True, groups = set(groups))
+            energies[i] = state.getPotentialEnergy()/kilojoules_per_mole
+        for name, value in zip(names, saved):
+            context.setParameter(name, value)
+        return energies
+
+    def _worker_statemove(self):
+        #moves the replica to a new state with the current configuration and
+        #returns the id of its state, no moves by default
+        return self.stateid
+
 class OMMWorkerTRE(OMMWorker):
     def _worker_setstate_fromqueue(self):
-        self.par = self._inq.get()
-        self.integrator.setTemperature(self.par['temperature'])
-        self.context.setParameter(self.ommsystem.parameter['temperature'], self.par['temperature']/kelvin)
+        stateid = self._inq.get()
+        self.stateid = stateid
+        self.par = self.state_table[stateid]
+        self.integrator.setTemperature(self.par['temperature']*kelvin)
+        self.context.setParameter(self.ommsystem.parameter['temperature'], float(self.par['temperature']))
   
     def _worker_getenergy(self):
         self.pot['potential_energy'] = self.context.getState(getEnergy = True).getPotentialEnergy()
@@ -335,16 +624,21 @@ class OMMWorkerTRE(OMMWorker):
 
 class OMMWorkerATM(OMMWorker):
     def _worker_setstate_fromqueue(self):
-        self.par = self._inq.get()
-        self.integrator.setTemperature(self.par['temperature'])
-        self.context.setParameter(self.ommsystem.parameter['temperature'], self.par['temperature']/kelvin)
+        self._worker_setstate(self._inq.get())
+
+    def _worker_setstate(self, stateid):
+        self.stateid = stateid
+        self.par = self.state_table[stateid]
+        self.integrator.setTemperature(self.par['temperature']*kelvin)
+        self.context.setParameter(self.ommsystem.parameter['temperature'], float(self.par['temperature']))
+        #the fields of the state table are already in OpenMM units
         atmforce = self.ommsystem.atmforce
-        self.simulation.context.setParameter(atmforce.Lambda1(), self.par['lambda1'])
-        self.simulation.context.setParameter(atmforce.Lambda2(), self.par['lambda2'])
-        self.simulation.context.setParameter(atmforce.Alpha(), self.par['alpha']*kilojoules_per_mole)
-        self.simulation.context.setParameter(atmforce.U0(), self.par['u0'] /kilojoules_per_mole)
-        self.simulation.context.setParameter(atmforce.W0(), self.par['w0'] /kilojoules_per_mole)
-        self.simulation.context.setParameter(atmforce.Direction(), self.par['atmdirection'] )
+        self.simulation.context.setParameter(atmforce.Lambda1(), float(self.par['lambda1']))
+        self.simulation.context.setParameter(atmforce.Lambda2(), float(self.par['lambda2']))
+        self.simulation.context.setParameter(atmforce.Alpha(), float(self.par['alpha']))
+        self.simulation.context.setParameter(atmforce.U0(), float(self.par['u0']))
+        self.simulation.context.setParameter(atmforce.W0(), float(self.par['w0']))
+        self.simulation.context.setParameter(atmforce.Direction(), float(self.par['atmdirection']))
 
     def _worker_getenergy(self):
         if self.ommsystem.metaD != None:
@@ -360,3 +654,70 @@ class OMMWorkerATM(OMMWorker):
         else:
             self.pot['bias_energy'] = 0.0 * kilojoules_per_mole
         self._outq.put(self.pot)
+
+    def _worker_reachablestates(self, stateid):
+        #ids of the states at the temperature of stateid with the same
+        #direction or, if stateid is intermediate, the intermediate states
+        table = self.state_table
+        par = table[stateid]
+        reachable = table['atmdirection'] == par['atmdirection']
+        if par['atmintermediate'] > 0:
+            reachable = reachable | (table['atmintermediate'] > 0)
+        return np.flatnonzero(reachable & (table['temperature'] == par['temperature']))
+
+    def _worker_statemove(self):
+        """
+        Expanded ensemble move of the replica among the states reachable from
+        its state at the same temperature, those with the same direction or,
+        from an intermediate state, the other intermediate states. Only the
+        alchemical potential differs among them, so the move requires only
+        the perturbation energy of the current configuration.
+
+        With state_moves = 'gibbs' the new state is drawn from the
+        distribution of the reachable states given the configuration, with
+        'metropolis' a move to the previous or the next reachable state is
+        proposed and accepted with the Metropolis criterion.
+
+        The reachable states differ between the intermediate states and the
+        others, so the proposals are not symmetric. For detailed balance the
+        draw of the 'gibbs' move is accepted with probability
+        min(1, Z(from)/Z(to)), Z being the sum of the Boltzmann factors of
+        the states reachable from a state, and the 'metropolis' move is
+        rejected unless the two states are also adjacent among the states
+        reachable from the new state.
+        """
+        table = self.state_table
+        #the perturbation energy is that of the last evaluation of the ATM
+        #force, which is evaluated here for the current configuration
+        self.simulation.context.getState(getEnergy = True, groups = {self.ommsystem.atmforcegroup})
+        pertpot = self.ommsystem.atmforce.getPerturbationEnergy(self.simulation.context)/kilojoules_per_mole
+        def logweights(states):
+            #minus the reduced energies of the states up to a common constant
+            st = table[states]
+            return -st['beta']*_softplus_array(st['lambda1'], st['lambda2'], st['alpha'], st['u0'], st['w0'], pertpot)
+        states = self._worker_reachablestates(self.stateid)
+        current = int(np.searchsorted(states, self.stateid))
+        x = logweights(states)
+        if self.state_moves == 'gibbs':
+            p = np.exp(x - np.max(x))
+            cp = np.cumsum(p)
+            k = min(int(np.searchsorted(cp, self.rng.random()*cp[-1], side='right')), len(states) - 1)
+            if k != current:
+                to = self._worker_reachablestates(states[k])
+                if not np.array_equal(to, states):
+                    dlogz = np.logaddexp.reduce(x) - np.logaddexp.reduce(logweights(to))
+                    if self.rng.random() >= np.exp(min(0., dlogz)):
+                        k = current
+        else:
+            k = current + (1 if self.rng.random() < 0.5 else -1)
+            if k < 0 or k >= len(states):
+                k = current
+            else:
+                to = self._worker_reachablestates(states[k])
+                if (abs(int(np.searchsorted(to, self.stateid)) - int(np.searchsorted(to, states[k]))) != 1
+                    or self.rng.random() >= np.exp(min(0., x[k] - x[current]))):
+                    k = current
+        stateid = int(states[k])
+        if stateid != self.stateid:
+            self._worker_setstate(stateid)
+        return stateid
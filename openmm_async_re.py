@@ -6,6 +6,7 @@ import random
 import math
 import logging
 import signal
+import numpy as np
 
 from simtk import openmm as mm
 from simtk.openmm.app import *
@@ -17,25 +18,103 @@ from local_openmm_transport import *
 from ommreplica import *
 from ommsystem import *
 from ommworker import *
+from ommworker import _softplus_array
 
 class openmm_job(async_re):
     def __init__(self, command_file, options):
+        self.kb = 0.0019872041*kilocalories_per_mole/kelvin
+        self.state_table = None
+        #incremented when the parameters in the state table change
+        self.state_table_version = 0
+        #local moves among the states between chunks of the segments,
+        #see openmm_job_ATM._checkInput()
+        self.state_moves = None
+        self.state_move_chunks = 1
         async_re.__init__(self, command_file, options)
         self.openmm_replicas = None
-        self.stateparams = None
         self.openmm_workers = None
-        self.kb = 0.0019872041*kilocalories_per_mole/kelvin
+        self._state_energy_request = None
+        #persistent matrix of reduced energies, see _computeSwapMatrix()
+        self._swap_matrix = None
+        self._swap_matrix_version = None
+        #reduced energies of the replicas in the states evaluated in the
+        #neighbor exchange mode, see _pairEnergies()
+        self._pair_energies = {}
+        self._energies_table_version = None
         
     def _setLogger(self):
         self.logger = logging.getLogger("async_re.openmm_async_re")
         
+    def setupJob(self):
+        #the workers receive the table of state parameters once, and then
+        #only the ids of the states of the replicas they run
+        for worker in self.openmm_workers:
+            worker.set_state_table(self.state_table)
+        async_re.setupJob(self)
+        #energies evaluated by the workers for generic Hamiltonian exchange
+        self._state_energy_request = self._stateEnergyParameters()
+        if self._state_energy_request is not None:
+            self.transport.setStateEnergies(*self._state_energy_request)
+
+    def _stateEnergyParameters(self):
+        """
+        Returns the parameter sets and force groups with which the workers
+        evaluate the energies of the replicas in every state at the end of
+        each segment, or None if the energies in the other states are
+        derived from the energies of the replica (the default).
+
+        Job classes for Hamiltonian exchange over arbitrary context parameters
+        (restraint strengths, scaling factors, ...) return a tuple
+        (parameter_sets, groups): parameter_sets is a structured array with a
+        row for each state and a field for each context parameter that
+        varies among the states; groups is the set of force groups that
+        depend on those parameters, or None for all of them. Restricting the
+        force groups is valid only if the states share the same temperature.
+        """
+        return None
+
+    def _stateTableChanged(self):
+        #to be called after changing the parameters in the state table,
+        #the workers receive the new table with their next state assignment
+        self.state_table_version += 1
+        for worker in self.openmm_workers:
+            worker.set_state_table(self.state_table)
+
+    def _stateOffsetsChanged(self, du):
+        #to be called after adding state-dependent constants to the energy
+        #functions of the states, du being the change of the reduced energy
+        #in each state. The cached energies are shifted rather than discarded
+        #and the workers receive the new table with their next state assignment
+        self._checkEnergyCaches()
+        if self._swap_matrix is not None:
+            self._swap_matrix += du[:,None]
+        for (version, energies) in self._pair_energies.values():
+            for stateid in energies:
+                energies[stateid] += du[stateid]
+        for worker in self.openmm_workers:
+            worker.set_state_table(self.state_table)
+
+    def _checkEnergyCaches(self):
+        #the cached reduced energies are discarded if the state table has changed
+        if self._energies_table_version != self.state_table_version:
+            self._swap_matrix = None
+            self._pair_energies = {}
+            self._energies_table_version = self.state_table_version
+
     def checkpointJob(self):
         #disable ctrl-c
         s = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # retrieve the coordinates of the replicas cached by the idle workers,
+        # those cached by busy workers are saved from the previous coordinates
+        # held by the replica objects, with the cycle, MD steps and energies
+        # that go with them
+        pending = self.transport.syncReplicas()
+        if len(pending) > 0:
+            self.logger.info("Replicas %s are checkpointed at their previous coordinates, their workers are busy" % pending)
         # update replica objects of waiting replicas
         self.update_replica_states()
         for replica in self.openmm_replicas:
-            replica.save_checkpoint()
+            replica.save_checkpoint(self.transport.posvelRecord(replica._id))
         signal.signal(signal.SIGINT, s)
 
     def _launchReplica(self,replica,cycle):
@@ -51,20 +130,38 @@ class openmm_job(async_re):
         """
         if nsteps % nprnt != 0:
             self._exit("nprnt must be an integer multiple of nsteps.")
-        if nsteps % ntrj != 0:
-            self._exit("ntrj must be an integer multiple of nsteps.")
+        #trajectory frames may be written once every few segments
+        if nsteps % ntrj != 0 and ntrj % nsteps != 0:
+            self._exit("ntrj must divide nsteps or be an integer multiple of it.")
 
         job_info = {
             "replica": replica,
             "cycle": cycle,
             "nsteps": nsteps,
             "nprnt": nprnt,
-            "ntrj": ntrj
+            "ntrj": ntrj,
+            "nchunks": self.state_move_chunks,
+            "state_moves": self.state_moves
         }
 
         status = self.transport.launchJob(replica, job_info)
         return status
 
+    def _applyStateMoves(self, repl):
+        #the replica has moved among the states during the segment, it is
+        #assigned the state in which it has ended the segment
+        replica = self.openmm_replicas[repl]
+        trajectory = replica.state_trajectory
+        if len(trajectory) == 0:
+            return
+        replica.state_trajectory = []
+        #end states visited within the segment count towards the round trips
+        for stateid in trajectory[:-1]:
+            self.stats.record_visit(repl, self._state_end(stateid), self.status.cycle[repl])
+        if trajectory[-1] != self.status.stateid[repl]:
+            self.status.set_stateid(repl, trajectory[-1])
+            self.logger.info("Replica %d new state %d" % (repl, trajectory[-1]))
+
     #sync replicas with the current state assignments
     def update_replica_states(self):
         for repl in range(self.nreplicas):
@@ -74,20 +171,20 @@ class openmm_job(async_re):
         replica = self.openmm_replicas[repl]
         #retrieve previous state if set
         (old_stateid, old_par) =  replica.get_state()
-        if old_stateid != None:
-            old_temperature = old_par['temperature']
         #sets new state
-        stateid = self.status[repl]['stateid_current']
-        par = self.stateparams[stateid]
-        replica.set_state(stateid, par)
+        stateid = self.status.stateid[repl]
+        par = self.state_table[stateid]
+        if not replica.set_state(stateid, par):
+            #state assignment has not changed
+            return
 
         #rescale velocities (relevant only if state has changed)
         if old_stateid != None:
             if stateid != old_stateid:
-                temperature = par['temperature']
-                scale = math.sqrt(temperature/old_temperature)
-                for i in range(0,len(replica.velocities)):
-                    replica.velocities[i] = scale*replica.velocities[i]
+                scale = math.sqrt(float(par['temperature'])/float(old_par['temperature']))
+                if scale != 1.0:
+                    for i in range(0,len(replica.velocities)):
+                        replica.velocities[i] = scale*replica.velocities[i]
 
         #additional operations if any
         self._update_state_of_replica_addcustom(replica)
@@ -99,6 +196,8 @@ class openmm_job(async_re):
         """
         Returns true if an OpenMM replica has successfully completed a cycle.
         """
+        if self.transport.segmentFailed(repl):
+            return False
         try:
             pot = self._getPot(repl)
             if pot is None:
@@ -107,6 +206,12 @@ class openmm_job(async_re):
             return False
         return True
 
+    def _isStopped(self, repl):
+        return self.transport.replicaStopped(repl)
+
+    def _replicasShareStates(self):
+        return self.state_moves is not None
+
     def _getPar(self, repl):
         replica = self.openmm_replicas[repl]
         (stateid, par) = replica.get_state()
@@ -130,37 +235,122 @@ class openmm_job(async_re):
         """
         # U will be sparse matrix, but is convenient bc the indices of the
         # rows and columns will always be the same.
-        U = [[ 0. for j in range(self.nreplicas)]
-             for i in range(self.nreplicas)]
-
-        n = len(repls)
-
-        #collect replica parameters and potentials
-        par = []
-        pot = []
-        for k in repls:
-            v = self._getPot(k)
-            l = self._getPar(k)
-            par.append(l)
-            pot.append(v)
-
-        for i in range(n):
-            repl_i = repls[i]
-            for j in range(n):
-                sid_j = states[j]
-                #energy of replica i in state j
-                U[sid_j][repl_i] = self._reduced_energy(par[j],pot[i])
+        U = np.zeros((self.nreplicas, self.nreplicas))
+        U[np.ix_(states, repls)] = self._cached_reduced_energies(repls, states)
         return U
 
+    def _cached_reduced_energies(self, repls, states):
+        """
+        Returns the reduced energies of the replicas in repls (columns) in
+        the states in states (rows) from a persistent matrix holding the
+        energies of every replica in every state.
+
+        The column of a replica depends only on its last energies and on the
+        state table, so it is recomputed only when the energy version of the
+        replica has changed since the column was last filled in. Only the
+        energies in the states compatible with the state in which the
+        energies of the replica were computed are evaluated, the others are
+        left infinite so that the swaps into those states are never accepted.
+        """
+        n = self.nreplicas
+        self._checkEnergyCaches()
+        if self._swap_matrix is None:
+            self._swap_matrix = np.full((n, n), np.inf)
+            self._swap_matrix_version = np.full(n, -1, dtype=np.int64)
+        stale = [k for k in repls if self.openmm_replicas[k].energy_version != self._swap_matrix_version[k]]
+        #the stale replicas are evaluated in groups with the same energy state
+        groups = {}
+        for k in stale:
+            groups.setdefault(self.openmm_replicas[k].energy_stateid, []).append(k)
+        for (stateid, ks) in groups.items():
+            if self.state_compatible is None or stateid is None:
+                rows = np.arange(n)
+            else:
+                rows = np.flatnonzero(self.state_compatible[stateid])
+            self._swap_matrix[:, ks] = np.inf
+            self._swap_matrix[np.ix_(rows, ks)] = self._reduced_energies(ks, rows)
+            self._swap_matrix_version[ks] = [self.openmm_replicas[k].energy_version for k in ks]
+        return self._swap_matrix[np.ix_(states, repls)]
+
+    def _pairEnergies(self, repls, states):
+        """
+        Returns the array of the dimension-less energies of replica repls[k]
+        in state states[k]. The energies are kept for each replica until its
+        energy version changes, so that only the pairs not evaluated since
+        the replica last ran are computed.
+        """
+        self._checkEnergyCaches()
+        u = np.zeros(len(repls))
+        missing = []
+        for i, (k, stateid) in enumerate(zip(repls, states)):
+            version = self.openmm_replicas[k].energy_version
+            (cached_version, energies) = self._pair_energies.get(k, (None, None))
+            if cached_version != version:
+                energies = {}
+                self._pair_energies[k] = (version, energies)
+            if stateid in energies:
+                u[i] = energies[stateid]
+            else:
+                missing.append(i)
+        if len(missing) > 0:
+            missing = np.array(missing)
+            u[missing] = self._reduced_energies_pairs(np.asarray(repls)[missing], np.asarray(states)[missing])
+            for i in missing:
+                self._pair_energies[repls[i]][1][states[i]] = u[i]
+        return u
+
+    def _state_energies(self, repls):
+        """
+        Returns the matrix of the energies in kJ/mol of the replicas in repls
+        (columns) in every state (rows) evaluated by the workers. The
+        energies of the replicas restored from a checkpoint are evaluated
+        with the service worker.
+        """
+        (parameter_sets, groups) = self._state_energy_request
+        energies = np.zeros((len(parameter_sets), len(repls)))
+        for i, k in enumerate(repls):
+            replica = self.openmm_replicas[k]
+            pot = replica.get_energy()
+            if 'state_energies' not in pot:
+                #the replicas do not track the box, the service context keeps
+                #the box of the checkpoints as for the trajectory files
+                replica.context.setPositions(replica.positions)
+                pot['state_energies'] = replica.worker.get_energies(parameter_sets, groups)
+            energies[:,i] = pot['state_energies']
+        return energies
+
+    def _reduced_energies(self, repls, states):
+        """
+        Returns the array of dimension-less energies of the replicas in repls
+        (columns) in each of the states in states (rows). Implemented by the
+        job classes using the fields of the state table set by _buildStates().
+        By default the energies are those evaluated by the workers, see
+        _stateEnergyParameters(), at the inverse temperatures in the 'beta'
+        field of the state table.
+        """
+        beta = self.state_table['beta'][states]
+        return beta[:,None]*self._state_energies(repls)[states,:]
+
+    def _reduced_energies_pairs(self, repls, states):
+        """
+        Returns the array of dimension-less energies of replica repls[k] in
+        state states[k]. Implemented by the job classes, by default from the
+        energies evaluated by the workers.
+        """
+        energies = self._state_energies(repls)
+        return self.state_table['beta'][states]*energies[states, np.arange(len(repls))]
 
 class openmm_job_TRE(openmm_job):
+    #fields of the state table: temperature in kelvin, inverse temperature in mol/kJ
+    state_dtype = np.dtype([('temperature', np.float64), ('beta', np.float64)])
+
     def _buildStates(self):
-        self.stateparams = []
-        for tempt in self.temperatures:
-            par = {}
-            par['temperature'] = float(tempt)*kelvin
-            self.stateparams.append(par)
-        return len(self.stateparams)
+        self.state_table = np.zeros(len(self.temperatures), dtype=self.state_dtype)
+        for i, tempt in enumerate(self.temperatures):
+            par = self.state_table[i]
+            par['temperature'] = float(tempt)
+            par['beta'] = (1./(self.kb*float(tempt)*kelvin))*kilojoules_per_mole
+        return len(self.state_table)
 
     def _checkInput(self):
         async_re._checkInput(self)
@@ -170,49 +360,48 @@ class openmm_job_TRE(openmm_job):
         self.temperatures = self.keywords.get('TEMPERATURES').split(',')
         self.nreplicas = self._buildStates()
 
-    def print_status(self):
-        """
-        Writes to BASENAME_stat.txt a text version of the status of the RE job
+    def _status_text(self):
+        lines = ["Replica  State   Temperature Status  Cycle "]
+        for k in range(self.nreplicas):
+            stateid = self.status.stateid[k]
+            lines.append("%6d   %5d  %6.2f %5s  %5d " % (k, stateid, self.state_table[stateid]['temperature'], self.status.running_status[k], self.status.cycle[k]))
+        lines.append("Running = %d" % self.running)
+        lines.append("Waiting = %d" % self.waiting)
+        return "\n".join(lines) + "\n"
 
-        It's fun to follow the progress in real time by doing:
+    def _reduced_energies(self, repls, states):
+        epot = np.array([self._getPot(k)['potential_energy']/kilojoules_per_mole for k in repls])
+        return np.outer(self.state_table['beta'][states], epot)
+
+    def _reduced_energies_pairs(self, repls, states):
+        epot = np.array([self._getPot(k)['potential_energy']/kilojoules_per_mole for k in repls])
+        return self.state_table['beta'][states]*epot
 
-        watch cat BASENAME_stat.txt
-        """
-        logfile = "%s_stat.txt" % self.basename
-        ofile = open(logfile,"w")
-        log = "Replica  State   Temperature Status  Cycle \n"
-        for k in range(self.nreplicas):
-            stateid = self.status[k]['stateid_current']
-            log += "%6d   %5d  %s %6.2f  %5d \n" % (k, stateid, self.stateparams[stateid]['temperature']/kelvin, self.status[k]['running_status'], self.status[k]['cycle_current'])
-        log += "Running = %d\n" % self.running
-        log += "Waiting = %d\n" % self.waiting
-
-        ofile.write(log)
-        ofile.close()
-
-    def _reduced_energy(self, par, pot):
-        temperature = par['temperature']
-        potential_energy = pot['potential_energy']
-        beta = 1./(self.kb*temperature)
-        return beta*potential_energy
-        
 class openmm_job_ATM(openmm_job):
+    #fields of the state table: energies in kJ/mol, alpha in mol/kJ,
+    #temperature in kelvin and inverse temperature in mol/kJ
+    state_dtype = np.dtype([('lambda', np.float64), ('atmdirection', np.float64), ('atmintermediate', np.float64),
+                            ('lambda1', np.float64), ('lambda2', np.float64), ('alpha', np.float64),
+                            ('u0', np.float64), ('w0', np.float64), ('temperature', np.float64), ('beta', np.float64)])
+
     def _buildStates(self):
-        self.stateparams = []
+        self.state_table = np.zeros(len(self.lambdas)*len(self.temperatures), dtype=self.state_dtype)
+        i = 0
         for (lambd,direction,intermediate,lambda1,lambda2,alpha,u0,w0) in zip(self.lambdas,self.directions,self.intermediates,self.lambda1s,self.lambda2s,self.alphas,self.u0s,self.w0coeffs):
             for tempt in self.temperatures:
-                par = {}
+                par = self.state_table[i]
                 par['lambda'] = float(lambd)
                 par['atmdirection'] = float(direction)
                 par['atmintermediate'] = float(intermediate)
                 par['lambda1'] = float(lambda1)
                 par['lambda2'] = float(lambda2)
-                par['alpha'] = float(alpha)/kilocalories_per_mole
-                par['u0'] = float(u0)*kilocalories_per_mole
-                par['w0'] = float(w0)*kilocalories_per_mole
-                par['temperature'] = float(tempt)*kelvin
-                self.stateparams.append(par)
-        return len(self.stateparams)
+                par['alpha'] = (float(alpha)/kilocalories_per_mole)*kilojoules_per_mole
+                par['u0'] = (float(u0)*kilocalories_per_mole)/kilojoules_per_mole
+                par['w0'] = (float(w0)*kilocalories_per_mole)/kilojoules_per_mole
+                par['temperature'] = float(tempt)
+                par['beta'] = (1./(self.kb*float(tempt)*kelvin))*kilojoules_per_mole
+                i += 1
+        return len(self.state_table)
 
     def _checkInput(self):
         async_re._checkInput(self)
@@ -248,37 +437,92 @@ class openmm_job_ATM(openmm_job):
         self.u0s = self.keywords.get('U0').split(',')
         self.w0coeffs = self.keywords.get('W0COEFF').split(',')
 
+        #online adjustment of the w0 offsets of the states by self-adjusted
+        #mixture sampling (SAMS), see _adaptStates()
+        adaptive_w0 = self.keywords.get('ADAPTIVE_W0')
+        self.adaptive_w0 = adaptive_w0 is not None and adaptive_w0.lower() == 'sams'
+        if self.keywords.get('SAMS_GAIN') is None:
+            self.sams_gain = 1.0
+        else:
+            self.sams_gain = float(self.keywords.get('SAMS_GAIN'))
+        if self.keywords.get('SAMS_DECAY') is None:
+            self.sams_decay = 0.6
+        else:
+            self.sams_decay = float(self.keywords.get('SAMS_DECAY'))
+
+        #expanded ensemble moves of the replicas among the states at the same
+        #temperature ('gibbs' or 'metropolis') in between LOCAL_MOVE_CHUNKS
+        #chunks of each segment, performed by the workers. Replicas may then
+        #share states, and the exchanges continue among the waiting replicas.
+        state_moves = self.keywords.get('LOCAL_STATE_MOVES')
+        if state_moves is not None and state_moves.lower() != 'no':
+            self.state_moves = state_moves.lower()
+            if self.state_moves not in ('gibbs', 'metropolis'):
+                self._exit("unknown LOCAL_STATE_MOVES %s" % state_moves)
+            if self.keywords.get('LOCAL_MOVE_CHUNKS') is None:
+                self.state_move_chunks = 10
+            else:
+                self.state_move_chunks = int(self.keywords.get('LOCAL_MOVE_CHUNKS'))
+            if self.state_move_chunks < 1 or int(self.keywords.get('PRODUCTION_STEPS')) % self.state_move_chunks != 0:
+                self._exit("PRODUCTION_STEPS must be an integer multiple of LOCAL_MOVE_CHUNKS")
+        #the w0 offsets cancel out in the exchanges of replicas in distinct
+        #states, they affect the sampling only with the local moves
+        if self.adaptive_w0 and self.state_moves is None:
+            self._exit("ADAPTIVE_W0 requires LOCAL_STATE_MOVES")
+
+        #refinement of the lambda schedule at checkpoints, see _refineStates()
+        lambda_refinement = self.keywords.get('LAMBDA_REFINEMENT')
+        self.lambda_refinement = lambda_refinement is not None and lambda_refinement.lower() == 'yes'
+        #a window is inserted between neighboring windows with a lower
+        #average acceptance probability
+        if self.keywords.get('REFINE_INSERT_ACCEPTANCE') is None:
+            self.refine_insert_acceptance = 0.2
+        else:
+            self.refine_insert_acceptance = float(self.keywords.get('REFINE_INSERT_ACCEPTANCE'))
+        #a window is removed if the acceptance with both its neighbors is higher
+        if self.keywords.get('REFINE_REMOVE_ACCEPTANCE') is None:
+            self.refine_remove_acceptance = 0.6
+        else:
+            self.refine_remove_acceptance = float(self.keywords.get('REFINE_REMOVE_ACCEPTANCE'))
+        #minimum number of swaps considered between two windows
+        if self.keywords.get('REFINE_MIN_ATTEMPTS') is None:
+            self.refine_min_attempts = 100
+        else:
+            self.refine_min_attempts = int(self.keywords.get('REFINE_MIN_ATTEMPTS'))
+
         #build parameters for the lambda/temperatures combined states
         self.nreplicas = self._buildStates()
-
-    def print_status(self):
-        """
-        Writes to BASENAME_stat.txt a text version of the status of the RE job
-
-        It's fun to follow the progress in real time by doing:
-
-        watch cat BASENAME_stat.txt
-        """
-        logfile = "%s_stat.txt" % self.basename
-        ofile = open(logfile,"w")
-        log = "Replica  State  Lambda Lambda1 Lambda2 Alpha U0 W0coeff Temperature Status  Cycle \n"
+        if self.lambda_refinement:
+            self._loadStateTable()
+        self.sams_updates = 0
+        self.w0_history = np.zeros((0, self.nreplicas))
+        if self.adaptive_w0:
+            self._loadAdaptiveW0()
+
+    def _status_text(self):
+        lines = ["Replica  State  Lambda Lambda1 Lambda2 Alpha U0 W0coeff Temperature Status  Cycle "]
         for k in range(self.nreplicas):
-            stateid = self.status[k]['stateid_current']
-            log += "%6d   %5d  %6.3f %6.3f %6.3f %6.3f %6.2f %6.2f %6.2f %5s  %5d\n" % (k, stateid, self.stateparams[stateid]['lambda'], self.stateparams[stateid]['lambda1'], self.stateparams[stateid]['lambda2'], self.stateparams[stateid]['alpha']*kilocalories_per_mole, self.stateparams[stateid]['u0']/kilocalories_per_mole, self.stateparams[stateid]['w0']/kilocalories_per_mole, self.stateparams[stateid]['temperature']/kelvin, self.status[k]['running_status'], self.status[k]['cycle_current'])
-        log += "Running = %d\n" % self.running
-        log += "Waiting = %d\n" % self.waiting
-
-        ofile.write(log)
-        ofile.close()
-
-    #evaluates the softplus function
-    def _softplus(self, lambda1, lambda2, alpha, u0, w0, uf):
-        ee = 1.0 + math.exp(-alpha*(uf-u0))
-        softplusf = lambda2 * uf + w0
-        if alpha._value > 0.:
-            softplusf += ((lambda2 - lambda1)/alpha) * math.log(ee)
-        return softplusf
-        
+            stateid = self.status.stateid[k]
+            par = self.state_table[stateid]
+            alpha = (par['alpha']/kilojoules_per_mole)*kilocalories_per_mole
+            u0 = (par['u0']*kilojoules_per_mole)/kilocalories_per_mole
+            w0 = (par['w0']*kilojoules_per_mole)/kilocalories_per_mole
+            lines.append("%6d   %5d  %6.3f %6.3f %6.3f %6.3f %6.2f %6.2f %6.2f %5s  %5d" % (k, stateid, par['lambda'], par['lambda1'], par['lambda2'], alpha, u0, w0, par['temperature'], self.status.running_status[k], self.status.cycle[k]))
+        lines.append("Running = %d" % self.running)
+        lines.append("Waiting = %d" % self.waiting)
+        return "\n".join(lines) + "\n"
+
+    def _state_end(self, stateid):
+        # the end states are those at the first and last alchemical step
+        # at any temperature
+        nlambdas = len(self.lambdas)
+        lambda_index = stateid // len(self.temperatures)
+        if lambda_index == 0:
+            return -1
+        elif lambda_index == nlambdas - 1:
+            return 1
+        return 0
+
     #customized getPot to return the unperturbed potential energy
     #of the replica U0 = U - W_lambda(u)
     def _getPot(self, repl):
@@ -286,41 +530,244 @@ class openmm_job_ATM(openmm_job):
         pot = replica.get_energy()
         epot = pot['potential_energy']
         pertpot = pot['perturbation_energy']
-        (stateid, par) = replica.get_state()
-        direction = par['atmdirection']
-        lambda1 = par['lambda1']
-        lambda2 = par['lambda2']
-        alpha = par['alpha']
-        u0 = par['u0']
-        w0 = par['w0']
-        ebias = self._softplus(lambda1, lambda2, alpha, u0, w0, pertpot)
-        pot['unbiased_potential_energy'] = epot - ebias
+        #the bias of the state in which the energies were computed
+        par = replica.energy_par
+        ebias = _softplus_array(par['lambda1'], par['lambda2'], par['alpha'], par['u0'], par['w0'],
+                                pertpot/kilojoules_per_mole)
+        pot['unbiased_potential_energy'] = epot - float(ebias)*kilojoules_per_mole
         pot['direction'] = par['atmdirection']
         pot['intermediate'] = par['atmintermediate']
         return pot
         
-    def _reduced_energy(self, par, pot):
-        temperature = par['temperature']
-        beta = 1./(self.kb*temperature)
-        direction = par['atmdirection']
-        lambda1 = par['lambda1']
-        lambda2 = par['lambda2']
-        alpha = par['alpha']
-        u0 = par['u0']
-        w0 = par['w0']
-        state_direction = par['atmdirection']
-        state_intermediate = par['atmintermediate']
-        epot0 = pot['unbiased_potential_energy']
-        pertpot = pot['perturbation_energy']
-        replica_direction = pot['direction']
-        replica_intermediate = pot['intermediate']
-        if (replica_direction == state_direction) or (state_intermediate > 0 and replica_intermediate > 0):
-            ebias = self._softplus(lambda1, lambda2, alpha, u0, w0, pertpot)
-            return beta*(epot0 + ebias)
-        else:
-            #prevent exchange
-            large_energy = 1.e12
-            return large_energy
+    def _replica_energies(self, repls):
+        """
+        Returns the unbiased potential energies and the perturbation energies
+        in kJ/mol of the replicas in repls, and the ids of the states in which
+        the energies were computed.
+        """
+        n = len(repls)
+        epot = np.zeros(n)
+        pertpot = np.zeros(n)
+        stateids = np.zeros(n, dtype=np.int64)
+        #parameters of the states in which the energies were computed
+        st = np.zeros(n, dtype=self.state_dtype)
+        for i, k in enumerate(repls):
+            replica = self.openmm_replicas[k]
+            pot = replica.get_energy()
+            epot[i] = pot['potential_energy']/kilojoules_per_mole
+            pertpot[i] = pot['perturbation_energy']/kilojoules_per_mole
+            stateids[i] = replica.energy_stateid
+            st[i] = replica.energy_par
+        ebias = _softplus_array(st['lambda1'], st['lambda2'], st['alpha'], st['u0'], st['w0'], pertpot)
+        return (epot - ebias, pertpot, stateids)
+
+    def _reduced_energies(self, repls, states):
+        epot0, pertpot, energy_states = self._replica_energies(repls)
+        st = self.state_table[np.asarray(states)][:,None]
+        ebias = _softplus_array(st['lambda1'], st['lambda2'], st['alpha'], st['u0'], st['w0'], pertpot[None,:])
+        return st['beta']*(epot0[None,:] + ebias)
+
+    def _reduced_energies_pairs(self, repls, states):
+        epot0, pertpot, energy_states = self._replica_energies(repls)
+        st = self.state_table[np.asarray(states)]
+        ebias = _softplus_array(st['lambda1'], st['lambda2'], st['alpha'], st['u0'], st['w0'], pertpot)
+        return st['beta']*(epot0 + ebias)
+
+    def _buildStateGraph(self):
+        #the states form a grid of lambda and temperature values, each state
+        #neighbors the compatible states at the adjacent lambda or temperature
+        nlambdas = len(self.lambdas)
+        ntemperatures = len(self.temperatures)
+        neighbors = []
+        for a in range(len(self.state_table)):
+            (lambda_index, temperature_index) = divmod(a, ntemperatures)
+            nb = []
+            for (l, t) in ((lambda_index - 1, temperature_index), (lambda_index + 1, temperature_index),
+                           (lambda_index, temperature_index - 1), (lambda_index, temperature_index + 1)):
+                if 0 <= l < nlambdas and 0 <= t < ntemperatures:
+                    b = l*ntemperatures + t
+                    if self.state_compatible[a][b]:
+                        nb.append(b)
+            neighbors.append(np.array(nb, dtype=np.int64))
+        return neighbors
+
+    def _buildStateCompatibility(self):
+        #replicas can visit only states with the same direction, or the
+        #intermediate states if they are in an intermediate state
+        direction = self.state_table['atmdirection']
+        intermediate = self.state_table['atmintermediate'] > 0
+        return (direction[:,None] == direction[None,:]) | (intermediate[:,None] & intermediate[None,:])
+
+    def _adaptStates(self, replicas):
+        """
+        SAMS update of the w0 offsets of the states (in kJ/mol) from the
+        replicas that have completed a segment.
+
+        The offsets converge to minus the free energies of the states so that
+        the states reachable from each state at the same temperature would be
+        visited uniformly. The estimates zeta_k = beta_k*w0_k are updated as
+
+        zeta_k += gamma*p_k(x)/pi_k
+
+        where p_k(x) is the probability of state k given the coordinates x of
+        the replica, pi_k = 1/n and gamma = SAMS_GAIN*min(1, (N/t)^SAMS_DECAY)
+        decreases with the number of updates t, N being the number of states.
+        The offset of the first of the reachable states is kept fixed.
+        """
+        if not self.adaptive_w0 or len(replicas) == 0:
+            return
+        table = self.state_table
+        nstates = len(table)
+        temperature_index = np.arange(nstates) % len(self.temperatures)
+        du = np.zeros(nstates)
+        for k in replicas:
+            replica = self.openmm_replicas[k]
+            if replica.get_energy() is None:
+                continue
+            s = replica.energy_stateid
+            states = np.flatnonzero(self.state_compatible[s] & (temperature_index == temperature_index[s]))
+            u = self._reduced_energies([k], states)[:,0]
+            p = np.exp(-(u - np.min(u)))
+            p /= np.sum(p)
+            self.sams_updates += 1
+            gamma = self.sams_gain*min(1., (float(nstates)/self.sams_updates)**self.sams_decay)
+            dzeta = gamma*len(states)*p
+            dzeta -= dzeta[0]
+            table['w0'][states] += dzeta/table['beta'][states]
+            du[states] += dzeta
+        #w0 is an additive constant of the bias, the cached energies are shifted
+        self._stateOffsetsChanged(du)
+
+    def _loadAdaptiveW0(self):
+        #restores the adapted w0 offsets saved with the last checkpoint
+        w0file = self.basename + "_w0_ckpt.npz"
+        if not os.path.isfile(w0file):
+            return
+        with np.load(w0file) as data:
+            if data['w0'].shape != self.state_table['w0'].shape:
+                self.logger.warning("%s does not match the current states, w0 offsets are not restored" % w0file)
+                return
+            self.state_table['w0'] = data['w0']
+            self.sams_updates = int(data['updates'])
+            self.w0_history = data['history']
+        self.state_table_version += 1
+
+    def _lambdaAcceptance(self, l):
+        #number of swaps considered between the windows at lambda index l and
+        #l+1, at any temperature, and their average acceptance probability
+        ntemperatures = len(self.temperatures)
+        attempted = 0
+        acceptance = 0.
+        for t in range(ntemperatures):
+            (n, acc) = self.stats.pair_acceptance(l*ntemperatures + t, (l + 1)*ntemperatures + t)
+            attempted += n
+            acceptance += acc
+        if attempted < self.refine_min_attempts:
+            return (attempted, None)
+        return (attempted, acceptance/attempted)
+
+    def _refineStates(self):
+        """
+        Moves a lambda window from where the windows overlap the most to
+        where they overlap the least, using as a measure of overlap the
+        average acceptance probability of the swaps between neighboring
+        windows.
+
+        The move is made within a leg of the alchemical path, the windows
+        with the same direction, when two neighboring windows have an
+        acceptance below REFINE_INSERT_ACCEPTANCE and a window, other than
+        the end and intermediate ones, has an acceptance above
+        REFINE_REMOVE_ACCEPTANCE with both of its neighbors. A window with
+        the average parameters is inserted between the first two and the
+        latter window is removed. The state ids do not change: the windows in
+        between are shifted by one position, so that each replica keeps its
+        coordinates and moves at most by one window. The number of states,
+        and of replicas, is unchanged and the direction and intermediate
+        flags of each state id are preserved.
+
+        The replicas running in the states whose parameters change complete
+        their segments with the old parameters, with which their energies
+        are tagged, see _replica_energies().
+        """
+        if not self.lambda_refinement:
+            return False
+        nlambdas = len(self.lambdas)
+        ntemperatures = len(self.temperatures)
+        windows = self.state_table.reshape(nlambdas, ntemperatures)
+        direction = windows['atmdirection'][:,0]
+        intermediate = windows['atmintermediate'][:,0] > 0
+        acceptance = [self._lambdaAcceptance(l)[1] for l in range(nlambdas - 1)]
+
+        best = None
+        start = 0
+        while start < nlambdas:
+            end = start
+            while end + 1 < nlambdas and direction[end + 1] == direction[start]:
+                end += 1
+            #pairs of windows (p, p+1) and windows r in the leg from start to end
+            pairs = [p for p in range(start, end) if acceptance[p] is not None and acceptance[p] < self.refine_insert_acceptance]
+            if len(pairs) > 0:
+                p = min(pairs, key=lambda p: acceptance[p])
+                removable = [r for r in range(start + 1, end)
+                             if not intermediate[r] and r != p and r != p + 1
+                             and acceptance[r - 1] is not None and acceptance[r] is not None
+                             and min(acceptance[r - 1], acceptance[r]) > self.refine_remove_acceptance]
+                if len(removable) > 0:
+                    r = max(removable, key=lambda r: min(acceptance[r - 1], acceptance[r]))
+                    if best is None or acceptance[p] < acceptance[best[0]]:
+                        best = (p, r)
+            start = end + 1
+        if best is None:
+            return False
+        (p, r) = best
+
+        inserted = windows[p].copy()
+        for name in ('lambda', 'lambda1', 'lambda2', 'alpha', 'u0', 'w0'):
+            inserted[name] = 0.5*(windows[p][name] + windows[p + 1][name])
+        inserted['atmintermediate'] = 0.
+        order = list(range(nlambdas))
+        del order[r]
+        rows = [windows[l] for l in order]
+        rows.insert(p + 1 if p < r else p, inserted)
+        new_windows = np.array(rows, dtype=self.state_dtype)
+
+        self.logger.info("Refining lambda schedule: inserting a window between lambda %f and %f, removing the window at lambda %f" %
+                         (windows[p][0]['lambda'], windows[p + 1][0]['lambda'], windows[r][0]['lambda']))
+        #the rows are changed in place, the replicas hold views of them
+        self.state_table[:] = new_windows.reshape(-1)
+        self._stateTableChanged()
+        return True
+
+    def _loadStateTable(self):
+        #restores the state table refined by a previous run
+        statefile = self.basename + "_states_ckpt.npz"
+        if not os.path.isfile(statefile):
+            return
+        with np.load(statefile) as data:
+            table = data['state_table']
+        if table.dtype != self.state_table.dtype or table.shape != self.state_table.shape:
+            self.logger.warning("%s does not match the current states, the lambda schedule is not restored" % statefile)
+            return
+        self.state_table[:] = table
+        self.state_table_version += 1
+
+    def checkpointStatistics(self):
+        openmm_job.checkpointStatistics(self)
+        if self.lambda_refinement:
+            statefile = self.basename + "_states_ckpt.npz"
+            tmpfile = statefile + ".tmp"
+            with open(tmpfile, 'wb') as f:
+                np.savez(f, state_table = self.state_table)
+            os.replace(tmpfile, statefile)
+        if not self.adaptive_w0:
+            return
+        #the history of the adapted w0 offsets holds their values at each checkpoint
+        self.w0_history = np.vstack([self.w0_history, self.state_table['w0']])
+        w0file = self.basename + "_w0_ckpt.npz"
+        tmpfile = w0file + ".tmp"
+        with open(tmpfile, 'wb') as f:
+            np.savez(f, w0 = self.state_table['w0'], updates = self.sams_updates, history = self.w0_history)
+        os.replace(tmpfile, w0file)
 
     def _update_state_of_replica_addcustom(self, replica):
         #changes the format of the positions in case of an exchange between replicas with two different directions 
@@ -334,7 +781,7 @@ class openmm_job_AmberTRE(openmm_job_TRE):
         prmtopfile = self.basename + ".prmtop"
         crdfile = self.basename + ".inpcrd"
 
-        if self.stateparams is None:
+        if self.state_table is None:
             self._buildStates()
 
         #builds service worker for replicas use
@@ -345,7 +792,9 @@ class openmm_job_AmberTRE(openmm_job_TRE):
         for i in range(self.nreplicas):
             replica = OMMReplicaTRE(i, self.basename, self.service_worker, self.logger)
             if replica.stateid == None:
-                replica.set_state(i, self.stateparams[i])#initial setting
+                replica.set_state(i, self.state_table[i])#initial setting
+            else:
+                replica.set_state(replica.stateid, self.state_table[replica.stateid])
             self.openmm_replicas.append(replica)
 
         # creates openmm workers
@@ -367,7 +816,7 @@ class openmm_job_AmberABFE(openmm_job_ATM):
         prmtopfile = self.basename + ".prmtop"
         crdfile = self.basename + ".inpcrd"
 
-        if self.stateparams is None:
+        if self.state_table is None:
             self._buildStates()
         
         #builds service worker for replicas use
@@ -378,7 +827,9 @@ class openmm_job_AmberABFE(openmm_job_ATM):
         for i in range(self.nreplicas):
             replica = OMMReplicaATM(i, self.basename, self.service_worker, self.logger)
             if replica.stateid == None:
-                replica.set_state(i, self.stateparams[i])#initial setting
+                replica.set_state(i, self.state_table[i])#initial setting
+            else:
+                replica.set_state(replica.stateid, self.state_table[replica.stateid])
             self.openmm_replicas.append(replica)
 
         # creates openmm workers objects
@@ -394,7 +845,7 @@ class openmm_job_AmberRBFE(openmm_job_ATM):
         prmtopfile = self.basename + ".prmtop"
         crdfile = self.basename + ".inpcrd"
 
-        if self.stateparams is None:
+        if self.state_table is None:
             self._buildStates()
         
         #builds service worker for replicas use
@@ -405,7 +856,9 @@ class openmm_job_AmberRBFE(openmm_job_ATM):
         for i in range(self.nreplicas):
             replica = OMMReplicaATM(i, self.basename, self.service_worker, self.logger)
             if replica.stateid == None:
-                replica.set_state(i, self.stateparams[i])#initial setting
+                replica.set_state(i, self.state_table[i])#initial setting
+            else:
+                replica.set_state(replica.stateid, self.state_table[replica.stateid])
             self.openmm_replicas.append(replica)
 
         # creates openmm context objects